@@ -74,11 +74,39 @@
 # FreeBSD 8.0 supports up to a level of Linux 2.6.16
 
 import argparse
+import atexit
+import csv
 import errno
+import fcntl
 import os
+import pwd
+import re
+import select
+import shutil
+import socket
 import sys
+import tarfile
+import threading
 import time
 import io
+import hashlib
+import heapq
+import json
+import random
+import resource
+import struct
+import tempfile
+from collections import namedtuple
+from functools import cmp_to_key
+from stat import S_ISREG
+try:
+    import ctypes  # Used for the kcmp() system call
+except ImportError:
+    ctypes = None
+try:
+    import numpy  # Used to process page frames in bulk with --physical
+except ImportError:
+    numpy = None
 
 # The following exits cleanly on Ctrl-C or EPIPE
 # while treating other exceptions as before.
@@ -99,9 +127,6 @@ sys.excepthook = std_exceptions
 PAGESIZE = os.sysconf("SC_PAGE_SIZE") / 1024 #KiB
 our_pid = os.getpid()
 
-have_pss = 0
-have_swap_pss = 0
-
 class Unbuffered(io.TextIOBase):
    def __init__(self, stream):
        super(Unbuffered, self).__init__()
@@ -112,36 +137,385 @@ class Unbuffered(io.TextIOBase):
    def close(self):
        self.stream.close()
 
-class Proc:
+# Per thread, reusable buffer for reading /proc files as bytes
+class ReadBuffer(threading.local):
     def __init__(self):
-        uname = os.uname()
-        if uname[0] == "FreeBSD":
+        self.buf = bytearray(64 * 1024)
+
+read_buffer = ReadBuffer()
+
+if sys.version_info < (3,):
+    import __builtin__
+    def buffer_view(buf, size):
+        # re doesn't accept memoryview on Python 2
+        return __builtin__.buffer(buf, 0, size)
+else:
+    def buffer_view(buf, size):
+        return memoryview(buf)[:size]
+
+def read_bytes(f):
+    """Read all of f into the reusable buffer, returning a view of the data"""
+    buf = read_buffer.buf
+    size = 0
+    while True:
+        if size == len(buf):
+            buf.extend(bytearray(len(buf)))
+        n = f.readinto(memoryview(buf)[size:])
+        if not n:
+            break
+        size += n
+    read_buffer.buf = buf
+    return buffer_view(buf, size)
+
+class Proc:
+    """Access to files in the proc file system mounted at root,
+    which defaults to that of the running system. Another root can be
+    specified to examine a copy of, or a synthetic proc file system."""
+
+    def __init__(self, root=None):
+        if root is not None:
+            self.proc = root
+        elif os.uname()[0] == "FreeBSD":
             self.proc = '/compat/linux/proc'
         else:
             self.proc = '/proc'
+        # The pid of ps_mem itself, as determined by the "self" link
+        # (if present) so that it can be excluded and used to probe
+        # the capabilities of the kernel.
+        self.self_pid = our_pid
+        # Whether the pids are those of the running system
+        self.live = root is None
+        if root is not None:
+            self.self_pid = None
+            try:
+                self.self_pid = int(os.readlink(self.path('self')))
+            except (OSError, ValueError):
+                pass
+
+        # Name of the most efficient smaps file the kernel provides,
+        # as determined by smaps_file()
+        self.smaps = None
+        # The process being examined by each thread, see ProcessDir
+        self.dirs = threading.local()
+        # pidfd_open() is only applicable to the running system
+        self.pidfd = self.live and hasattr(os, 'pidfd_open')
 
     def path(self, *args):
         return os.path.join(self.proc, *(str(a) for a in args))
 
+    def dir_fd(self, args):
+        """Return the directory handle to use to access the file args,
+        if it's a file of the process being examined by this thread"""
+        current = getattr(self.dirs, 'current', None)
+        if current is not None and len(args) == 2 and args[0] == current[0]:
+            return current[1]
+        return None
+
     def open(self, *args):
+        return self._open(args, False)
+
+    def open_binary(self, *args):
+        return self._open(args, True)
+
+    def _open(self, args, binary):
         try:
+            dir_fd = self.dir_fd(args)
+            if dir_fd is not None:
+                def opener(name, flags):
+                    return os.open(name, flags, dir_fd=dir_fd)
+                if binary:
+                    return io.open(args[1], 'rb', 0, opener=opener)
+                return io.open(args[1], errors='ignore', opener=opener)
+            if binary:
+                return io.open(self.path(*args), 'rb', 0)
             if sys.version_info < (3,):
                 return open(self.path(*args))
-            else:
-                return open(self.path(*args), errors='ignore')
+            return open(self.path(*args), errors='ignore')
         except (IOError, OSError):
             if type(args[0]) is not int:
                 raise
             val = sys.exc_info()[1]
             if (val.errno == errno.ENOENT or # kernel thread or process gone
+                val.errno == errno.ESRCH or # process gone (or kernel thread)
                 val.errno == errno.EPERM or
                 val.errno == errno.EACCES):
                 raise LookupError
             raise
 
+    def readlink(self, pid, name):
+        dir_fd = self.dir_fd((pid, name))
+        if dir_fd is not None:
+            return os.readlink(name, dir_fd=dir_fd)
+        return os.readlink(self.path(pid, name))
+
+    def smaps_file(self, pid):
+        """Return the name of the most efficient smaps file provided by
+        the kernel, or '' if not supported. This is probed once, using
+        our own process if possible, otherwise the passed pid."""
+        if self.smaps is None and probes is not None and self.live:
+            self.smaps = probes.get('smaps_file')
+        if self.smaps is None:
+            probe = self.self_pid
+            if probe is None:
+                probe = pid
+            smaps = ''
+            if os.path.exists(self.path(probe, 'smaps')):
+                smaps = 'smaps'
+                if os.path.exists(self.path(probe, 'smaps_rollup')):
+                    smaps = 'smaps_rollup' # faster to process
+            self.smaps = smaps
+            if probes is not None and self.live:
+                probes['smaps_file'] = smaps
+        return self.smaps
+
+
+# Whether directory handles can be used to access files
+have_dir_fd = (sys.version_info >= (3, 3) and os.open in os.supports_dir_fd
+               and os.readlink in os.supports_dir_fd)
+
+class ProcessDir:
+    """Context manager in which files of a process accessed through Proc
+    by the current thread, are accessed relative to a handle of the
+    /proc/$pid directory. This avoids resolving the full path for each
+    file, and ensures that all files are from the same process, even if
+    the pid is reused, as files of an exited process give ESRCH.
+    Where supported, a pidfd is used to verify the directory opened
+    is that of the process present when examination started."""
+
+    def __init__(self, proc, pid):
+        self.proc = proc
+        self.pid = pid
+        self.fd = None
+
+    def __enter__(self):
+        if not have_dir_fd:
+            return self
+        proc = self.proc
+        pidfd = None
+        if proc.pidfd:
+            try:
+                pidfd = os.pidfd_open(self.pid)
+            except OSError:
+                val = sys.exc_info()[1]
+                if val.errno == errno.ESRCH:
+                    raise LookupError
+                proc.pidfd = False  # Not supported by the kernel
+        try:
+            self.fd = os.open(proc.path(self.pid),
+                              os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            raise LookupError
+        finally:
+            if pidfd is not None:
+                # If the process exited, the pid could have been reused
+                # before we opened the directory
+                gone = select.select([pidfd], [], [], 0)[0]
+                os.close(pidfd)
+                if gone and self.fd is not None:
+                    os.close(self.fd)
+                    raise LookupError
+        proc.dirs.current = (self.pid, self.fd)
+        return self
+
+    def __exit__(self, etype, value, tb):
+        if self.fd is not None:
+            self.proc.dirs.current = None
+            os.close(self.fd)
+            self.fd = None
+
+
 proc = Proc()
 
 
+#
+#   Profiling of ps_mem itself, enabled with --profile.
+#   When disabled, the profiler global is None and proc is a plain Proc,
+#   so only a few checks of profiler per process remain.
+#
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+profiler = None
+
+class Profiler:
+    """Time per phase, files read and the slowest processes examined"""
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.lock = threading.Lock()
+        self.phases = {}  # name -> [wall, user, sys, count]
+        self.order = []  # phase names in the order first seen
+        self.files = {}  # file name -> [opened, bytes read]
+        self.processes = []  # (wall, pid, cmd)
+        self.smaps_sizes = {}  # pid -> bytes of smaps read
+        self.vanished = 0
+        self.samples = 0
+
+    def phase(self, name):
+        return ProfilePhase(self, name)
+
+    def add_phase(self, name, wall, user, system):
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = [0, 0, 0, 0]
+                self.order.append(name)
+            phase[0] += wall
+            phase[1] += user
+            phase[2] += system
+            phase[3] += 1
+
+    def add_file(self, name, opened, size):
+        with self.lock:
+            counts = self.files.setdefault(name, [0, 0])
+            counts[0] += opened
+            counts[1] += size
+
+    def add_process(self, pid, wall, stats):
+        """Record the examination of pid which returned stats"""
+        with self.lock:
+            self.processes.append((wall, pid, stats and stats[1]))
+            if len(self.processes) > 4 * self.slowest:
+                self.processes.sort(reverse=True)
+                del self.processes[self.slowest:]
+        if stats is None and not os.path.exists(proc.path(pid)):
+            with self.lock:
+                self.vanished += 1
+
+    def report(self):
+        """Return the measurements as a dict, with times in seconds"""
+        self.processes.sort(reverse=True)
+        return {
+            'samples': self.samples,
+            'phases': [dict(zip(('name', 'wall', 'user', 'sys', 'count'),
+                                [name] + self.phases[name]))
+                       for name in self.order],
+            'files': [{'name': name, 'opened': counts[0], 'bytes': counts[1]}
+                      for name, counts in sorted(self.files.items())],
+            'slowest': [{'pid': pid, 'wall': wall, 'name': cmd,
+                         'smaps_bytes': self.smaps_sizes.get(pid, 0)}
+                        for wall, pid, cmd in
+                        self.processes[:self.slowest]],
+            'vanished': self.vanished,
+        }
+
+    def write(self, stream, output_format='human'):
+        report = self.report()
+        if output_format != 'human':
+            report['type'] = 'profile'
+            stream.write(json.dumps(report, sort_keys=True) + '\n')
+            return
+        lines = ["Samples profiled: %d" % report['samples'], "",
+                 "%-20s %10s %10s %10s %6s" %
+                 ("Phase", "Wall ms", "User ms", "Sys ms", "Count")]
+        for phase in report['phases']:
+            lines.append("%-20s %10.1f %10.1f %10.1f %6d" %
+                         (phase['name'], phase['wall'] * 1000,
+                          phase['user'] * 1000, phase['sys'] * 1000,
+                          phase['count']))
+        width = max([20] + [len(f['name']) for f in report['files']])
+        lines += ["", "%-*s %10s %10s" % (width, "File", "Opened", "Bytes")]
+        for f in report['files']:
+            lines.append("%-*s %10d %10d" %
+                         (width, f['name'], f['opened'], f['bytes']))
+        lines += ["", "Processes vanished while examined: %d"
+                  % report['vanished'], "",
+                  "%-8s %10s %12s  %s" % ("Pid", "Wall ms", "Smaps bytes",
+                                          "Slowest processes")]
+        for process in report['slowest']:
+            lines.append("%-8d %10.1f %12d  %s" %
+                         (process['pid'], process['wall'] * 1000,
+                          process['smaps_bytes'], process['name'] or ''))
+        stream.write('\n'.join(lines) + '\n')
+
+
+class ProfilePhase:
+    """Context manager measuring a phase of a Profiler, or nothing
+    if profiler is None"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.usage = resource.getrusage(resource.RUSAGE_SELF)
+            self.start = timer()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        if self.profiler is not None:
+            wall = timer() - self.start
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            self.profiler.add_phase(self.name, wall,
+                                    usage.ru_utime - self.usage.ru_utime,
+                                    usage.ru_stime - self.usage.ru_stime)
+
+
+def profile_phase(name):
+    return ProfilePhase(profiler, name)
+
+
+class ProfilingProc(Proc):
+    """Proc that counts the files opened and bytes read with profiler"""
+
+    def _open(self, args, binary):
+        return CountingFile(Proc._open(self, args, binary), args[-1])
+
+    def readlink(self, pid, name):
+        profiler.add_file(name, 1, 0)
+        return Proc.readlink(self, pid, name)
+
+
+class CountingFile:
+    """File wrapper adding the bytes read to profiler when closed"""
+
+    def __init__(self, f, name):
+        self.f = f
+        self.name = name
+        self.size = 0
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.size += len(data)
+        return data
+
+    def readinto(self, buf):
+        n = self.f.readinto(buf)
+        self.size += n or 0
+        return n
+
+    def readline(self, *args):
+        line = self.f.readline(*args)
+        self.size += len(line)
+        return line
+
+    def readlines(self):
+        lines = self.f.readlines()
+        self.size += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        for line in self.f:
+            self.size += len(line)
+            yield line
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            profiler.add_file(self.name, 1, self.size)
+
+    def __del__(self):
+        self.close()
+
+
 #
 #   Functions
 #
@@ -178,6 +552,37 @@ def parse_options():
         metavar='<pid>[,pid2,...pidN]',
         help='Only show memory usage PIDs in the specified list',
     )
+    parser.add_argument(
+        '-u', '--user',
+        dest='users',
+        metavar='<user>[,user2,...userN]',
+        help='Only show processes of the specified users (names or uids)',
+    )
+    parser.add_argument(
+        '--comm',
+        metavar='<REGEX>',
+        type=parse_regex,
+        help='Only show processes whose command name (as in'
+             ' /proc/PID/comm) matches REGEX',
+    )
+    parser.add_argument(
+        '--exe',
+        metavar='<REGEX>',
+        type=parse_regex,
+        help='Only show processes whose executable path matches REGEX',
+    )
+    parser.add_argument(
+        '--in-cgroup',
+        metavar='<REGEX>',
+        type=parse_regex,
+        help='Only show processes whose memory cgroup path matches REGEX',
+    )
+    parser.add_argument(
+        '--min-rss',
+        metavar='<KiB>',
+        type=int,
+        help='Only show processes with a resident set size of at least KiB',
+    )
     parser.add_argument(
         '-w',
         dest='watch',
@@ -185,6 +590,224 @@ def parse_options():
         type=int,
         help='Measure and show process memory every N seconds',
     )
+    parser.add_argument(
+        '--adaptive',
+        metavar='<SECONDS>',
+        type=float,
+        help='With -w, poll memory pressure every SECONDS, and measure'
+             ' every SECONDS rather than every N seconds while under'
+             ' pressure, and when pressure peaks. The measurement at the'
+             ' peak is shown again when the pressure subsides',
+    )
+    parser.add_argument(
+        '--pressure',
+        metavar='<PCT>',
+        type=float,
+        default=10,
+        help='With --adaptive, the percentage of time stalled on memory'
+             ' (per /proc/pressure/memory) considered pressure (default 10)',
+    )
+    parser.add_argument(
+        '--min-available',
+        metavar='<PCT>',
+        type=float,
+        default=10,
+        help='With --adaptive, the percentage of MemAvailable in'
+             ' /proc/meminfo considered pressure below (default 10)',
+    )
+    parser.add_argument(
+        '--max-cpu',
+        metavar='<PCT>',
+        type=float,
+        help='With -w, limit the CPU time used by ps_mem to PCT percent,'
+             ' measuring less often than requested if needed',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='<N>',
+        type=int,
+        default=1,
+        help='Examine processes using N concurrent workers',
+    )
+    parser.add_argument(
+        '--incremental',
+        metavar='<N>',
+        type=int,
+        help='With -w, only re-examine processes that changed,'
+             ' re-examining all processes every N iterations',
+    )
+    parser.add_argument(
+        '--events',
+        action='store_true',
+        help='With -w, follow process events from the kernel rather than'
+             ' listing all processes each iteration, and also show'
+             ' programs that started and exited between iterations.'
+             ' Processes are only re-examined if changed as with'
+             ' --incremental 10, unless specified. This may require root',
+    )
+    parser.add_argument(
+        '--top',
+        metavar='<N>',
+        type=int,
+        help='Only show the N programs using the most RAM, avoiding'
+             ' examining the memory of most processes',
+    )
+    parser.add_argument(
+        '--sample',
+        metavar='<N>',
+        type=int,
+        help='Estimate memory per command name from a random sample of N'
+             ' processes, stratified by command name and RSS, showing'
+             ' 95%% confidence intervals. Command names with all'
+             ' processes sampled are measured exactly',
+    )
+    parser.add_argument(
+        '--sample-time',
+        metavar='<SECONDS>',
+        type=float,
+        help='Like --sample, but sample as many processes as possible'
+             ' in SECONDS. Can be combined with --sample',
+    )
+    parser.add_argument(
+        '--mappings',
+        action='store_true',
+        help='Show memory by mapped file or type (heap, stack, ...)'
+             ' over all processes, rather than by program',
+    )
+    parser.add_argument(
+        '--physical',
+        action='store_true',
+        help='Show the RAM mapped only by each program (Unique)'
+             ' and also by other programs (Shared), from the physical'
+             ' pages of each process. This is exact, but requires root',
+    )
+    parser.add_argument(
+        '--numa',
+        action='store_true',
+        help='Also show the RAM used by each program on each NUMA node,'
+             ' as anonymous, file backed and hugetlb memory, marking'
+             ' programs with most of it on nodes remote from their CPUs',
+    )
+    parser.add_argument(
+        '--tree',
+        metavar='<DEPTH>',
+        type=int,
+        nargs='?',
+        const=-1,
+        help='Show memory by process subtree in an indented tree view,'
+             ' rather than by program. If DEPTH is specified, processes'
+             ' deeper than DEPTH are included in their ancestor at DEPTH',
+    )
+    parser.add_argument(
+        '--cgroup',
+        metavar='<DEPTH>',
+        type=int,
+        nargs='?',
+        const=-1,
+        help='Show memory by cgroup rather than by program, alongside'
+             ' the kernel accounting for each cgroup. If DEPTH is specified,'
+             ' cgroups are combined with their ancestor at that depth',
+    )
+    parser.add_argument(
+        '--cgroup-only',
+        action='store_true',
+        help='With --cgroup, only show the kernel accounting for each'
+             ' cgroup, without examining processes',
+    )
+    parser.add_argument(
+        '--exporter',
+        metavar='<[HOST:]PORT|unix:PATH>',
+        type=parse_exporter_address,
+        help='Serve metrics in the Prometheus text format at the address,'
+             ' with HOST defaulting to 127.0.0.1',
+    )
+    parser.add_argument(
+        '--exporter-interval',
+        metavar='<N>',
+        type=int,
+        default=30,
+        help='With --exporter, examine processes every N seconds'
+             ' (default 30)',
+    )
+    parser.add_argument(
+        '--exporter-top',
+        metavar='<N>',
+        type=int,
+        default=20,
+        help='With --exporter, report the N largest programs individually'
+             ' and the rest combined in ps_mem_other_* metrics (default 20)',
+    )
+    parser.add_argument(
+        '--format',
+        choices=('human', 'json', 'csv'),
+        default='human',
+        help='Output format. json writes a JSON object per line (JSON Lines)'
+             ' and csv a row per line, with values in bytes, for each'
+             ' program followed by a total. (default human)',
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='<N>',
+        type=int,
+        nargs='?',
+        const=10,
+        help='Report the time taken by each phase, files read, and the'
+             ' N slowest processes to examine (default 10) on stderr',
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='<FILE>',
+        help='Keep the names of processes and the results of probing the'
+             ' kernel in FILE, for use by subsequent invocations in the'
+             ' same boot. FILE can be shared by concurrent invocations',
+    )
+    parser.add_argument(
+        '--proc-root',
+        metavar='<DIR>',
+        help='Examine the proc file system at DIR rather than /proc.'
+             ' DIR can also be an archive written by --capture',
+    )
+    parser.add_argument(
+        '--capture',
+        metavar='<FILE>',
+        help='Write the /proc files needed to examine the processes'
+             ' to the compressed archive FILE, for later use with'
+             ' --proc-root',
+    )
+    parser.add_argument(
+        '--record',
+        metavar='<FILE>',
+        help='Append each measurement to FILE, for later use with --replay',
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='<FILE>',
+        help='Show measurements from FILE rather than the running system',
+    )
+    parser.add_argument(
+        '--at',
+        metavar='<TIME>',
+        type=parse_time,
+        help='With --replay, show the last measurement at or before TIME,'
+             ' given as seconds since the epoch or "YYYY-MM-DD HH:MM:SS"',
+    )
+    parser.add_argument(
+        '--program',
+        metavar='<NAME>',
+        help='With --replay, summarize the range of RAM used by program NAME',
+    )
+    parser.add_argument(
+        '--since',
+        metavar='<TIME>',
+        type=parse_time,
+        help='With --program, only consider measurements from TIME',
+    )
+    parser.add_argument(
+        '--until',
+        metavar='<TIME>',
+        type=parse_time,
+        help='With --program, only consider measurements up to TIME',
+    )
     args = parser.parse_args()
 
     args.pids_to_show = []
@@ -194,22 +817,205 @@ def parse_options():
         except ValueError:
             parser.error('Invalid PID(s): %s' % args.pids)
 
+    args.uids = []
+    if args.users:
+        for user in args.users.split(','):
+            try:
+                args.uids.append(user_uid(user))
+            except KeyError:
+                parser.error('Invalid user: %s' % user)
+
+    if args.min_rss is not None and args.min_rss <= 0:
+        parser.error('KiB must be positive! (%s)' % args.min_rss)
+
     if args.watch is not None:
         if args.watch <= 0:
             parser.error('Seconds must be positive! (%s)' % args.watch)
 
-    return (
-        args.split_args,
-        args.pids_to_show,
-        args.watch,
-        args.only_total,
-        args.discriminate_by_pid,
-        args.show_swap,
-    )
+    if args.adaptive is not None or args.max_cpu is not None:
+        if args.watch is None:
+            parser.error('--adaptive and --max-cpu require -w')
+        if args.adaptive is not None and not 0 < args.adaptive <= args.watch:
+            parser.error('Seconds must be positive and at most those of -w!'
+                         ' (%s)' % args.adaptive)
+        if args.max_cpu is not None and not 0 < args.max_cpu <= 100:
+            parser.error('Percentage must be between 0 and 100! (%s)'
+                         % args.max_cpu)
+    for pct in (args.pressure, args.min_available):
+        if not 0 <= pct <= 100:
+            parser.error('Percentage must be between 0 and 100! (%s)' % pct)
+
+    if args.jobs <= 0:
+        parser.error('Jobs must be positive! (%s)' % args.jobs)
+
+    if args.incremental is not None:
+        if args.watch is None:
+            parser.error('--incremental requires -w')
+        if args.incremental <= 0:
+            parser.error('Iterations must be positive! (%s)'
+                         % args.incremental)
+
+    if args.events:
+        if args.watch is None:
+            parser.error('--events requires -w')
+        if (args.only_total or args.top is not None or args.sample is not None
+                or args.sample_time is not None
+                or args.proc_root is not None):
+            parser.error('--events is incompatible with -t, --top, --sample,'
+                         ' --proc-root')
+
+    if args.mappings and (args.watch is not None or args.record is not None
+                          or args.discriminate_by_pid or args.split_args):
+        parser.error('--mappings is incompatible with -w, -d, -s, --record')
+
+    if args.physical and (args.watch is not None or args.record is not None
+                          or args.show_swap or args.mappings):
+        parser.error('--physical is incompatible with -w, -S, --record,'
+                     ' --mappings')
+
+    # An archive has only the files needed for the default report,
+    # captured once, and not the cgroups of the captured system
+    if (args.proc_root is not None and os.path.isfile(args.proc_root)
+            and (args.mappings or args.physical or args.numa
+                 or args.watch is not None or args.cgroup is not None
+                 or args.cgroup_only or args.in_cgroup)):
+        parser.error('--mappings, --physical, --numa, -w, --cgroup,'
+                     ' --cgroup-only and --in-cgroup are incompatible'
+                     ' with a --proc-root archive')
+
+    if args.top is not None:
+        if args.top <= 0:
+            parser.error('Programs must be positive! (%s)' % args.top)
+        if (args.only_total or args.mappings or args.incremental
+                or args.physical):
+            parser.error('--top is incompatible with -t, --mappings,'
+                         ' --incremental, --physical')
+
+    if args.exporter is not None:
+        if args.exporter_interval <= 0:
+            parser.error('Seconds must be positive! (%s)'
+                         % args.exporter_interval)
+        if args.exporter_top < 0:
+            parser.error('Programs must not be negative! (%s)'
+                         % args.exporter_top)
+        if (args.watch is not None or args.only_total or args.mappings
+                or args.physical):
+            parser.error('--exporter is incompatible with -w, -t, --mappings,'
+                         ' --physical')
+
+    if args.numa and (
+            args.watch is not None or args.record is not None
+            or args.only_total or args.mappings or args.physical
+            or args.top is not None or args.tree is not None
+            or args.exporter is not None or args.capture is not None):
+        parser.error('--numa is incompatible with -w, --record, -t,'
+                     ' --mappings, --physical, --top, --tree, --exporter,'
+                     ' --capture')
+
+    if args.tree is not None and (
+            args.watch is not None or args.record is not None
+            or args.only_total or args.discriminate_by_pid or args.mappings
+            or args.physical or args.top is not None
+            or args.exporter is not None or args.cgroup is not None):
+        parser.error('--tree is incompatible with -w, --record, -t, -d,'
+                     ' --mappings, --physical, --top, --exporter, --cgroup')
+
+    if args.sample is not None or args.sample_time is not None:
+        if args.sample is not None and args.sample <= 0:
+            parser.error('Processes must be positive! (%s)' % args.sample)
+        if args.sample_time is not None and args.sample_time <= 0:
+            parser.error('Seconds must be positive! (%s)' % args.sample_time)
+        if (args.split_args or args.discriminate_by_pid or args.incremental
+                or args.top is not None or args.mappings or args.physical
+                or args.numa or args.tree is not None
+                or args.cgroup is not None or args.capture is not None):
+            parser.error('--sample is incompatible with -s, -d, --incremental,'
+                         ' --top, --mappings, --physical, --numa, --tree,'
+                         ' --cgroup, --capture')
+
+    if args.cgroup_only and args.cgroup is None:
+        parser.error('--cgroup-only requires --cgroup')
+
+    if args.format != 'human' and (
+            args.mappings or args.physical or args.numa
+            or args.tree is not None
+            or args.exporter is not None or args.capture is not None
+            or args.replay is not None or args.cgroup_only):
+        parser.error('--format is incompatible with --mappings, --physical,'
+                     ' --numa, --tree, --exporter, --capture, --replay,'
+                     ' --cgroup-only')
+
+    if args.profile is not None:
+        if args.profile < 0:
+            parser.error('Processes must not be negative! (%s)'
+                         % args.profile)
+        if (args.replay is not None or args.exporter is not None
+                or args.capture is not None):
+            parser.error('--profile is incompatible with --replay,'
+                         ' --exporter, --capture')
+
+    if args.capture is not None and (
+            args.watch is not None or args.record is not None
+            or args.replay is not None or args.proc_root is not None
+            or args.exporter is not None):
+        parser.error('--capture is incompatible with -w, --record, --replay,'
+                     ' --proc-root, --exporter')
+
+    if args.cache is not None and (
+            args.proc_root is not None or args.replay is not None
+            or args.capture is not None or args.mappings or args.physical
+            or args.numa or args.tree is not None
+            or args.exporter is not None):
+        parser.error('--cache is incompatible with --proc-root, --replay,'
+                     ' --capture, --mappings, --physical, --numa, --tree,'
+                     ' --exporter')
+
+    if args.replay is None:
+        if args.at is not None or args.program is not None:
+            parser.error('--at and --program require --replay')
+    elif args.record is not None:
+        parser.error('--record and --replay are mutually exclusive')
+
+    return args
+
+
+def user_uid(user):
+    """Return the uid of the user name or number"""
+    if user.isdigit():
+        return int(user)
+    return pwd.getpwnam(user).pw_uid
+
+
+def parse_regex(value):
+    try:
+        return re.compile(value)
+    except re.error:
+        raise argparse.ArgumentTypeError('Invalid regex: %s' % value)
+
+
+def parse_time(value):
+    """Parse seconds since the epoch, or a local date and time"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid time: %s' % value)
 
 
 # (major,minor,release)
+# Results of probing the kernel by name, when kept across invocations
+# by PersistentCache, otherwise None
+probes = None
+
 def kernel_ver():
+    if probes is not None and 'kernel_ver' in probes:
+        return tuple(probes['kernel_ver'])
     kv = proc.open('sys/kernel/osrelease').readline().split(".")[:3]
     last = len(kv)
     if last == 2:
@@ -223,163 +1029,762 @@ def kernel_ver():
         except:
             kv[last] = 0
         last -= 1
-    return (int(kv[0]), int(kv[1]), int(kv[2]))
+    kv = (int(kv[0]), int(kv[1]), int(kv[2]))
+    if probes is not None:
+        probes['kernel_ver'] = kv
+    return kv
+
+
+# Fields of interest from /proc/$pid/smaps{,_rollup}.
+# Note {Private,Shared}_{Clean,Dirty,Hugetlb} are matched by prefix.
+# Matching from the newline rather than with ^ is about twice as fast,
+# and the first line is always a mapping header rather than a field.
+first_line_re = re.compile(br'[^\n]*')
+smaps_field_re = re.compile(
+    br'\n(Pss|SwapPss|Swap|Shared\w*|Private\w*):[ \t]*([0-9]+)'
+)
 
+# Memory stats for a process in KiB, as returned by getMemStats().
+# have_pss and have_swap_pss indicate whether the kernel provided
+# Pss and SwapPss for the process, i.e. whether the values can be totalled.
+MemStats = namedtuple(
+    'MemStats',
+    'private shared shared_huge swap mem_id have_pss have_swap_pss'
+)
 
-#return Private,Shared,Swap(Pss),unique_id
+#return MemStats(Private,Shared,Shared_huge,Swap(Pss),unique_id,...)
 #Note shared is always a subset of rss (trs is not always)
 def getMemStats(pid):
-    global have_pss
-    global have_swap_pss
+    have_pss = 0
+    have_swap_pss = 0
     mem_id = pid #unique
-    Private_lines = []
-    Shared_lines = []
-    Private_huge_lines = []
-    Shared_huge_lines = []
-    Pss_lines = []
-    Rss = (int(proc.open(pid, 'statm').readline().split()[1])
-           * PAGESIZE)
-    Swap_lines = []
-    Swap_pss_lines = []
+    statm = proc.open(pid, 'statm').readline().split()
+    Rss = int(statm[1]) * PAGESIZE
 
     Swap = 0
 
-    if os.path.exists(proc.path(pid, 'smaps')):  # stat
-        smaps = 'smaps'
-        if os.path.exists(proc.path(pid, 'smaps_rollup')):
-            smaps = 'smaps_rollup' # faster to process
-        lines = proc.open(pid, smaps).readlines()  # open
-        # Note we checksum smaps as maps is usually but
-        # not always different for separate processes.
-        mem_id = hash(''.join(lines))
-        for line in lines:
-            # {Private,Shared}_Hugetlb is not included in Pss (why?)
-            # so we need to account for separately.
-            if line.startswith("Private_Hugetlb:"):
-                Private_huge_lines.append(line)
-            elif line.startswith("Shared_Hugetlb:"):
-                Shared_huge_lines.append(line)
-            elif line.startswith("Shared"):
-                Shared_lines.append(line)
-            elif line.startswith("Private"):
-                Private_lines.append(line)
-            elif line.startswith("Pss:"):
-                have_pss = 1
-                Pss_lines.append(line)
-            elif line.startswith("Swap:"):
-                Swap_lines.append(line)
-            elif line.startswith("SwapPss:"):
-                have_swap_pss = 1
-                Swap_pss_lines.append(line)
-        Shared = sum([int(line.split()[1]) for line in Shared_lines])
-        Private = sum([int(line.split()[1]) for line in Private_lines])
-        Shared_huge = sum([int(line.split()[1]) for line in Shared_huge_lines])
-        Private_huge = sum([int(line.split()[1]) for line in Private_huge_lines])
+    smaps = proc.smaps_file(pid)
+    if smaps:
+        f = proc.open_binary(pid, smaps)  # open
+        try:
+            data = read_bytes(f)
+        finally:
+            f.close()
+        if profiler is not None:
+            profiler.smaps_sizes[pid] = len(data)
+        # The first mapping (or the extent of all mappings for the rollup)
+        header = first_line_re.match(data).group()
+        # Sum each field in a single pass over the raw data,
+        # avoiding splitting into and decoding of lines.
+        fields = {}
+        pss_count = 0
+        for match in smaps_field_re.finditer(data):
+            field, value = match.groups()
+            fields[field] = fields.get(field, 0) + int(value)
+            if field == b'Pss':
+                pss_count += 1
+        # {Private,Shared}_Hugetlb is not included in Pss (why?)
+        # so we need to account for separately.
+        Shared_huge = fields.pop(b'Shared_Hugetlb', 0)
+        Private_huge = fields.pop(b'Private_Hugetlb', 0)
+        Shared = 0
+        Private = 0
+        for field, value in fields.items():
+            if field.startswith(b'Shared'):
+                Shared += value
+            elif field.startswith(b'Private'):
+                Private += value
         #Note Shared + Private = Rss above
         #The Rss in smaps includes video card mem etc.
+        if pss_count:
+            have_pss = 1
         if have_pss:
             pss_adjust = 0.5 # add 0.5KiB as this avg error due to truncation
-            Pss = sum([float(line.split()[1])+pss_adjust for line in Pss_lines])
+            Pss = fields.get(b'Pss', 0) + pss_adjust * pss_count
             Shared = Pss - Private
         Private += Private_huge  # Add after as PSS doesn't a/c for huge pages
+        if b'SwapPss' in fields:
+            have_swap_pss = 1
         if have_swap_pss:
             # The kernel supports SwapPss, that shows proportional swap share.
             # Note that Swap - SwapPss is not Private Swap.
-            Swap = sum([int(line.split()[1]) for line in Swap_pss_lines])
+            Swap = fields.get(b'SwapPss', 0)
         else:
             # Note that Swap = Private swap + Shared swap.
-            Swap = sum([int(line.split()[1]) for line in Swap_lines])
+            Swap = fields.get(b'Swap', 0)
+        # A cheap fingerprint of the address space, for VmIdentity.
+        # Note maps is usually but not always different for separate
+        # processes, so this is only indicative on its own.
+        mem_id = (header, Private, Shared, Shared_huge, Swap)
     elif (2,6,1) <= kernel_ver() <= (2,6,9):
         Shared = 0 #lots of overestimation, but what can we do?
         Shared_huge = 0
         Private = Rss
     else:
-        Shared = int(proc.open(pid, 'statm').readline().split()[2])
-        Shared *= PAGESIZE
+        Shared = int(statm[2]) * PAGESIZE
         Shared_huge = 0
         Private = Rss - Shared
-    return (Private, Shared, Shared_huge, Swap, mem_id)
+    return MemStats(Private, Shared, Shared_huge, Swap, mem_id,
+                    have_pss, have_swap_pss)
 
 
-def getCmdName(pid, split_args, discriminate_by_pid, exe_only=False):
-    cmdline = proc.open(pid, 'cmdline').read().split("\0")
-    while cmdline[-1] == '' and len(cmdline) > 1:
-        cmdline = cmdline[:-1]
+class VmIdentity:
+    """Identify processes sharing an address space (mm), as is the case
+    for processes created with CLONE_VM but without CLONE_THREAD.
+    Processes are first grouped by a cheap fingerprint of the address
+    space, and then where supported, the kcmp() system call is used
+    to determine exactly which processes in a group share an mm."""
 
-    path = proc.path(pid, 'exe')
-    try:
-        path = os.readlink(path)
-        # Some symlink targets were seen to contain NULs on RHEL 5 at least
-        # https://github.com/pixelb/scripts/pull/10, so take string up to NUL
-        path = path.split('\0')[0]
-    except OSError:
-        val = sys.exc_info()[1]
-        if (val.errno == errno.ENOENT or # either kernel thread or process gone
-            val.errno == errno.EPERM or
-            val.errno == errno.EACCES):
-            raise LookupError
-        raise
+    # kcmp() system call numbers by machine, and pointer size
+    # to distinguish 32 bit processes on 64 bit kernels.
+    syscalls = {
+        ('x86_64', 8): 312, ('x86_64', 4): 349,
+        ('i386', 4): 349, ('i486', 4): 349,
+        ('i586', 4): 349, ('i686', 4): 349,
+        ('aarch64', 8): 272, ('aarch64', 4): 378,
+        ('armv7l', 4): 378, ('armv8l', 4): 378,
+        ('ppc64le', 8): 354, ('ppc64', 8): 354, ('ppc', 4): 354,
+        ('s390x', 8): 343,
+        ('riscv64', 8): 272,
+        ('loongarch64', 8): 272,
+    }
+    KCMP_VM = 1
+    kcmp = None  # The syscall function, once found to be usable
+    probed = False
 
-    if split_args:
-        return ' '.join(cmdline).replace('\n', ' ')
-    if path.endswith(" (deleted)"):
-        path = path[:-10]
-        if os.path.exists(path):
-            path += " [updated]"
-        else:
-            #The path could be have prelink stuff so try cmdline
-            #which might have the full path present. This helped for:
-            #/usr/libexec/notification-area-applet.#prelink#.fX7LCT (deleted)
-            if os.path.exists(cmdline[0]):
-                path = cmdline[0] + " [updated]"
-            else:
-                path += " [deleted]"
-    exe = os.path.basename(path)
-    if exe_only: return exe
+    def __init__(self, proc):
+        self.proc = proc
+        if proc.live and not VmIdentity.probed:
+            VmIdentity.probed = True
+            kcmp = self.find_kcmp()
+            if kcmp is not None:
+                VmIdentity.kcmp = staticmethod(kcmp)
 
-    proc_status = proc.open(pid, 'status').readlines()
-    cmd = proc_status[0][6:-1]
-    if exe.startswith(cmd):
-        cmd = exe #show non truncated version
-        #Note because we show the non truncated name
-        #one can have separated programs as follows:
-        #584.0 KiB +   1.0 MiB =   1.6 MiB    mozilla-thunder (exe -> bash)
-        # 56.0 MiB +  22.2 MiB =  78.2 MiB    mozilla-thunderbird-bin
-    else:
-        #Lookup the parent's exe and use that if matching
-        #which will merge "Web Content" with "firefox" for example
-        ppid = 0
-        for l in range(10):
-            ps_line = proc_status[l]
-            if ps_line.startswith('PPid:'):
-                ppid = int(ps_line[6:-1])
-                break
-        if ppid:
-            try:
-                p_exe = getCmdName(ppid, False, False, exe_only=True)
-            except LookupError:
-                pass
-            else:
-                if exe == p_exe:
-                    cmd = exe
-    if sys.version_info >= (3,):
-        cmd = cmd.encode(errors='replace').decode()
-    if discriminate_by_pid:
-        cmd = '%s [%d]' % (cmd, pid)
-    return cmd
+    def find_kcmp(self):
+        if ctypes is None:
+            return None
+        machine = (os.uname()[4], ctypes.sizeof(ctypes.c_void_p))
+        nr = self.syscalls.get(machine)
+        if nr is None:
+            return None
+        try:
+            syscall = ctypes.CDLL(None, use_errno=True).syscall
+        except (OSError, AttributeError):
+            return None
+        def kcmp(pid1, pid2):
+            return syscall(nr, pid1, pid2, self.KCMP_VM, 0, 0)
+        # Not available if the kernel was built without
+        # CONFIG_CHECKPOINT_RESTORE, or it's blocked by seccomp etc.
+        if kcmp(our_pid, our_pid) != 0:
+            return None
+        return kcmp
 
+    def duplicates(self, items):
+        """Return the set of pids from the (pid, group, fingerprint) items,
+        that share the address space of an earlier pid of the same group.
+        Where supported, kcmp() is used to compare all pids of each group
+        (normally a command), by sorting them in the order of their mm.
+        Otherwise processes with the same fingerprint are considered to
+        share an address space, unless the fingerprint is None."""
+        groups = {}  # group -> [(index, pid, fingerprint)]
+        for index, (pid, group, fingerprint) in enumerate(items):
+            groups.setdefault(group, []).append((index, pid, fingerprint))
+        duplicates = set()
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            unknown = members
+            if self.proc.live and VmIdentity.kcmp is not None:
+                # Processes gone or not permitted can't be compared
+                known = [member for member in members
+                         if VmIdentity.kcmp(member[1], member[1]) == 0]
+                unknown = [member for member in members
+                           if member not in known]
+                known.sort(key=cmp_to_key(self.compare))
+                first = None
+                for member in known:
+                    if first is None or self.compare(first, member) != 0:
+                        first = member
+                    elif member[0] < first[0]:
+                        duplicates.add(first[1])  # keep the earliest
+                        first = member
+                    else:
+                        duplicates.add(member[1])
+            firsts = {}  # fingerprint -> pid
+            for index, pid, fingerprint in unknown:
+                if fingerprint is None:
+                    continue
+                if fingerprint in firsts:
+                    duplicates.add(pid)
+                else:
+                    firsts[fingerprint] = pid
+        return duplicates
 
-#The following matches "du -h" output
-#see also human.py
-def human(num, power="Ki", units=None):
-    if units is None:
-        powers = ["Ki", "Mi", "Gi", "Ti"]
-        while num >= 1000: #4 digits
-            num /= 1024.0
-            power = powers[powers.index(power)+1]
-        return "%.1f %sB" % (num, power)
-    else:
-        return "%.f" % ((num * 1024) / units)
+    @staticmethod
+    def compare(member1, member2):
+        """Order (index, pid, fingerprint) by the mm of the pid,
+        as kcmp() returns 0 if equal, 1 if less and 2 if greater"""
+        ret = VmIdentity.kcmp(member1[1], member2[1])
+        if ret == 1:
+            return -1
+        if ret == 2:
+            return 1
+        if ret == 0:
+            return 0
+        # Process gone in the meantime
+        return (member1[1] > member2[1]) - (member1[1] < member2[1])
+
+
+# Indexes of fields returned by getStat(), which are offset by 3 from
+# the field numbers documented for /proc/$pid/stat in proc(5)
+STAT_PPID = 1
+STAT_FLAGS = 6
+STAT_MINFLT = 7
+STAT_MAJFLT = 9
+STAT_STARTTIME = 19
+STAT_RSS = 21
+
+PF_KTHREAD = 0x00200000  # flag of kernel threads in /proc/$pid/stat
+
+#return comm,[fields following comm in /proc/$pid/stat]
+def getStat(pid):
+    stat = proc.open(pid, 'stat').read()
+    # comm can contain spaces and parens, so delimit by the outermost
+    comm_end = stat.rindex(')')
+    return stat[stat.index('(') + 1:comm_end], stat[comm_end + 2:].split()
+
+
+class NameCache:
+    """Cache of getCmdName() results for use across watch iterations.
+    Entries are validated against the start time and comm of the pid,
+    so are discarded if the pid is reused, or the process execs.
+    With check_exe, entries are also validated against the executable,
+    so that they're discarded if it's replaced (as it's then shown
+    as [updated] or [deleted]), for entries kept for a long time."""
+
+    def __init__(self, check_exe=False):
+        self.check_exe = check_exe
+        self.names = {}  # pid -> ((starttime, comm[, exe]), cmd)
+        self.exes = {}  # pid -> ((starttime, comm[, exe]), exe)
+
+    def identity(self, pid, stat=None):
+        comm, fields = stat or getStat(pid)
+        if self.check_exe:
+            return fields[STAT_STARTTIME], comm, getExe(pid)
+        return fields[STAT_STARTTIME], comm
+
+    def cmd_name(self, pid, split_args, discriminate_by_pid, stat=None,
+                 tree=None):
+        ident = self.identity(pid, stat)
+        entry = self.names.get(pid)
+        if entry is None or entry[0] != ident:
+            cmd = getCmdName(pid, split_args, discriminate_by_pid,
+                             name_cache=self, tree=tree)
+            entry = self.names[pid] = (ident, cmd)
+        return entry[1]
+
+    def exe(self, pid, tree=None):
+        stat = None
+        if tree is not None:
+            stat = tree.stats.get(pid)  # if the parent was also selected
+        ident = self.identity(pid, stat)
+        entry = self.exes.get(pid)
+        if entry is None or entry[0] != ident:
+            exe = getCmdName(pid, False, False, exe_only=True)
+            entry = self.exes[pid] = (ident, exe)
+        return entry[1]
+
+    def prune(self, pids):
+        """Drop entries for processes no longer present in pids"""
+        for cache in (self.names, self.exes):
+            for pid in [pid for pid in cache if pid not in pids]:
+                del cache[pid]
+
+
+# Version of the PersistentCache file format
+CACHE_VERSION = 2
+CACHE_MAX_NAMES = 32768
+
+class PersistentCache:
+    """Program names and kernel probes kept in a file across invocations,
+    so that frequent one-shot runs only need to read the memory of each
+    process. The file is only used in the boot it was written in, and only
+    if it's a regular file private to the user. It's written by renaming
+    a new file over it, so is always complete when read, while writers
+    are serialized with a lock on FILE.lock so entries aren't lost.
+    When written, entries of processes no longer present are dropped,
+    and at most max_names entries are kept, most recently used first."""
+
+    def __init__(self, path, max_names=CACHE_MAX_NAMES):
+        self.path = path
+        self.max_names = max_names
+        self.boot_id = proc.open('sys/kernel/random/boot_id').read().strip()
+        self.data = self.read()
+        self.probes = self.data.get('probes', {})
+
+    @staticmethod
+    def open_private(path, flags):
+        """Return a descriptor for path opened with flags, or None if it's
+        not a regular file owned by us and inaccessible to others.
+        Symlinks are not followed, so they can't redirect writes."""
+        try:
+            fd = os.open(path, flags | os.O_NOFOLLOW | os.O_NONBLOCK, 0o600)
+        except OSError:
+            return None  # not present, or a symlink
+        st = os.fstat(fd)
+        if (not S_ISREG(st.st_mode) or st.st_uid != os.geteuid()
+                or st.st_mode & 0o077):
+            os.close(fd)
+            return None
+        return fd
+
+    def read(self):
+        """Return the data in the file, or {} if not valid for this boot"""
+        fd = self.open_private(self.path, os.O_RDONLY)
+        if fd is None:
+            return {}
+        with os.fdopen(fd) as f:
+            try:
+                data = json.loads(f.read())
+            except ValueError:
+                return {}  # corrupted
+        if (not isinstance(data, dict)
+                or data.get('version') != CACHE_VERSION
+                or data.get('boot_id') != self.boot_id):
+            return {}
+        return data
+
+    @staticmethod
+    def refuse(path):
+        sys.stderr.write("Not writing the cache, as %s is not a private"
+                         " file of the user\n" % path)
+
+    @staticmethod
+    def variant(split_args, discriminate_by_pid):
+        return '%d %d' % (bool(split_args), bool(discriminate_by_pid))
+
+    def name_cache(self, split_args, discriminate_by_pid):
+        """Return a NameCache with the entries from the file"""
+        name_cache = NameCache(check_exe=True)
+        names = self.data.get('names', {}).get(
+            self.variant(split_args, discriminate_by_pid), {})
+        for cache, entries in ((name_cache.names, names),
+                               (name_cache.exes, self.data.get('exes', {}))):
+            for pid, (ident, name, used) in entries.items():
+                if sys.version_info < (3,):
+                    ident = [value.encode('utf-8') for value in ident]
+                    name = name.encode('utf-8')
+                cache[int(pid)] = (tuple(ident), name)
+        return name_cache
+
+    def save(self, name_cache, split_args, discriminate_by_pid):
+        """Merge the entries of name_cache and probes into the file"""
+        lock = self.open_private(self.path + '.lock', os.O_RDWR | os.O_CREAT)
+        if lock is None:
+            return self.refuse(self.path + '.lock')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Merge with entries written since we read the file
+            data = self.read()
+            names = data.setdefault('names', {})
+            variant = self.variant(split_args, discriminate_by_pid)
+            pids = list_pids(())[1]
+            now = int(time.time())
+            for name, entries, cache in (
+                    (variant, names.get(variant, {}), name_cache.names),
+                    (None, data.get('exes', {}), name_cache.exes)):
+                for pid, (ident, value) in cache.items():
+                    if sys.version_info < (3,):
+                        try:
+                            ident = [item.decode('utf-8') for item in ident]
+                            value = value.decode('utf-8')
+                        except UnicodeDecodeError:
+                            continue
+                    entries[str(pid)] = [list(ident), value, now]
+                entries = sorted(((pid, entry)
+                                  for pid, entry in entries.items()
+                                  if int(pid) in pids),
+                                 key=lambda item: -item[1][2])
+                entries = dict(entries[:self.max_names])
+                if name is None:
+                    data['exes'] = entries
+                else:
+                    names[name] = entries
+            data['probes'] = data.get('probes', {})
+            data['probes'].update(self.probes)
+            data['version'] = CACHE_VERSION
+            data['boot_id'] = self.boot_id
+
+            try:
+                existing = os.lstat(self.path)
+            except OSError:
+                pass  # not written yet
+            else:
+                if (not S_ISREG(existing.st_mode)
+                        or existing.st_uid != os.geteuid()):
+                    return self.refuse(self.path)
+            fd, temp = tempfile.mkstemp(
+                prefix='.ps_mem', dir=os.path.dirname(self.path) or '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(json.dumps(data, sort_keys=True))
+                os.rename(temp, self.path)
+            except:
+                os.unlink(temp)
+                raise
+        finally:
+            os.close(lock)
+
+
+class StatsCache:
+    """Cache of getMemStats() results for use across watch iterations.
+    A process is only re-examined if its start time, comm, fault counters
+    or rss changed since the last iteration. Note the shared portion of
+    an unchanged process can still vary as other processes map or unmap
+    the same pages, so every process is re-examined each refresh iterations.
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.stats = {}  # pid -> (signature, getMemStats(pid))
+        self.iteration = 0
+        self.full = True
+        self.lock = threading.Lock()
+        self.examined = 0
+        self.reread = 0
+
+    def start(self, pids):
+        """Start a new iteration, dropping entries for processes
+        no longer present in pids"""
+        for pid in [pid for pid in self.stats if pid not in pids]:
+            del self.stats[pid]
+        self.full = self.iteration % self.refresh == 0
+        self.iteration += 1
+        self.examined = 0
+        self.reread = 0
+
+    def mem_stats(self, pid, stat=None):
+        comm, fields = stat or getStat(pid)
+        signature = (fields[STAT_STARTTIME], comm, fields[STAT_MINFLT],
+                     fields[STAT_MAJFLT], fields[STAT_RSS])
+        entry = self.stats.get(pid)
+        reread = self.full or entry is None or entry[0] != signature
+        if reread:
+            entry = self.stats[pid] = (signature, getMemStats(pid))
+        with self.lock:
+            self.examined += 1
+            self.reread += reread
+        return entry[1]
+
+
+# The netlink proc connector (linux/cn_proc.h), for process events
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+NLMSG_DONE = 3
+nlmsghdr = struct.Struct('=IHHII')  # len, type, flags, seq, pid
+cn_msg = struct.Struct('=IIIIHH')  # idx, val, seq, ack, len, flags
+# what, cpu, timestamp, and the first 4 fields of the event data, which
+# are the parent pid, tgid, child pid and tgid for PROC_EVENT_FORK,
+# or the process pid and tgid for PROC_EVENT_EXEC and PROC_EVENT_EXIT
+proc_event = struct.Struct('=IIQIIII')
+
+# Seconds after exec that a process is first examined by ProcEvents,
+# doubling for each subsequent examination until it's sampled
+EVENT_EXAMINE_DELAY = 0.1
+
+# With ProcEvents, unless incremental is specified, the iterations between
+# re-examining processes not changed according to StatsCache
+EVENT_REFRESH = 10
+
+
+class ProcEvents:
+    """Live table of processes, maintained from the fork, exec and exit
+    events of the netlink proc connector, for use across watch iterations
+    rather than listing /proc each time. Processes that exec are examined
+    soon after in the background, so that those exiting before the next
+    iteration can still be reported. Subscribing may require root,
+    and socket.error is raised if that isn't possible."""
+
+    def __init__(self, pids_to_show=(), split_args=False,
+                 discriminate_by_pid=False, group_key=None):
+        self.pids_to_show = pids_to_show
+        self.split_args = split_args
+        self.discriminate_by_pid = discriminate_by_pid
+        self.group_key = group_key
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                  NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((0, CN_IDX_PROC))
+            op = struct.pack('=I', PROC_CN_MCAST_LISTEN)
+            self.sock.send(nlmsghdr.pack(nlmsghdr.size + cn_msg.size + 4,
+                                         NLMSG_DONE, 0, 0, os.getpid()) +
+                           cn_msg.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, 4, 0) +
+                           op)
+        except socket.error:
+            self.sock.close()
+            raise
+        self.lock = threading.Condition()
+        # Listed after subscribing, so that no process is missed
+        self.pids = list_pids(())[1]
+        self.resync = False  # whether events were lost
+        self.changed = set()  # pids that exec'd or exited
+        self.new = {}  # pid -> [name, MemStats with the most RAM]
+        self.exited = []  # (pid, name, MemStats) of new processes exited
+        self.due = []  # heap of (time, pid, delay) to examine new processes
+        for target in (self.receive, self.examine):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                val = sys.exc_info()[1]
+                if val.errno == errno.ENOBUFS:
+                    with self.lock:
+                        self.resync = True
+                    continue
+                if val.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset + nlmsghdr.size <= len(data):
+                length, msg_type = nlmsghdr.unpack_from(data, offset)[:2]
+                start = offset + nlmsghdr.size + cn_msg.size
+                if (msg_type == NLMSG_DONE and
+                        start + proc_event.size <= min(offset + length,
+                                                       len(data))):
+                    self.event(*proc_event.unpack_from(data, start))
+                if not length:
+                    break
+                offset += (length + 3) & ~3
+
+    def event(self, what, cpu, timestamp, pid, tgid, child_pid, child_tgid):
+        with self.lock:
+            if what == PROC_EVENT_FORK:
+                if child_pid == child_tgid:  # not a thread
+                    self.pids.add(child_tgid)
+            elif what == PROC_EVENT_EXEC:
+                self.pids.add(tgid)
+                self.changed.add(tgid)
+                self.new[tgid] = [None, None]
+                heapq.heappush(self.due, (timer() + EVENT_EXAMINE_DELAY,
+                                          tgid, EVENT_EXAMINE_DELAY))
+                self.lock.notify()
+            elif what == PROC_EVENT_EXIT and pid == tgid:
+                self.pids.discard(tgid)
+                self.changed.add(tgid)
+                new = self.new.pop(tgid, None)
+                if new and new[1] is not None:
+                    self.exited.append((tgid, new[0], new[1]))
+
+    def examine(self):
+        """Examine new processes as they become due, until they're sampled
+        or exit, retaining the largest RAM used"""
+        while True:
+            with self.lock:
+                while not self.due or self.due[0][0] > timer():
+                    self.lock.wait(self.due and self.due[0][0] - timer()
+                                   or None)
+                when, pid, delay = heapq.heappop(self.due)
+                if pid not in self.new:
+                    continue
+            try:
+                if self.pids_to_show and pid not in self.pids_to_show:
+                    with self.lock:
+                        self.new.pop(pid, None)
+                    continue
+                with ProcessDir(proc, pid):
+                    name = get_proc_cmd(pid, self.split_args,
+                                        self.discriminate_by_pid,
+                                        group_key=self.group_key)
+                    stats = getMemStats(pid)
+            except (LookupError, RuntimeError):
+                continue  # kernel thread, process gone or not permitted
+            ram = stats.private + stats.shared
+            with self.lock:
+                new = self.new.get(pid)
+                if new is None:
+                    continue  # sampled or exited in the meantime
+                if new[1] is None or ram > new[1].private + new[1].shared:
+                    new[:] = name, stats
+                heapq.heappush(self.due, (timer() + delay * 2, pid,
+                                          delay * 2))
+
+    def list_pids(self, pids_to_show, include_self=False, only_self=False):
+        """Return the same as list_pids() from the live table.
+        New processes are included, so no longer examined separately."""
+        with self.lock:
+            if self.resync:
+                self.pids = list_pids(())[1]
+                self.resync = False
+            self.new.clear()
+            all_pids = set(self.pids)
+        return list_pids(pids_to_show, include_self, only_self, all_pids)
+
+    def take_changed(self):
+        """Return the pids that exec'd or exited since the last call"""
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return changed
+
+    def take_exited(self):
+        """Return [(pid, name, MemStats)] of the processes that exec'd and
+        exited since list_pids() was last called"""
+        with self.lock:
+            exited, self.exited = self.exited, []
+        return exited
+
+
+class ProcessTree:
+    """Parent/child relationships of processes, built from a single pass
+    over /proc/$pid/stat. This also provides the comm and parent of each
+    process to getCmdName(), and the executable of parents which is
+    looked up only once however many children a process has."""
+
+    def __init__(self, pids):
+        self.stats = {}  # pid -> getStat(pid)
+        for pid in pids:
+            try:
+                self.stats[pid] = getStat(pid)
+            except LookupError:
+                pass  # process gone
+        self.exes = {}  # pid -> exe name or None if not accessible
+
+    def parent(self, pid):
+        return int(self.stats[pid][1][STAT_PPID])
+
+    def children(self):
+        """Return {pid: [child pids]}, including 0 and other pids
+        not in the tree for the roots"""
+        children = {}
+        for pid in sorted(self.stats):
+            children.setdefault(self.parent(pid), []).append(pid)
+        return children
+
+    def roots(self):
+        """Return the pids whose parent is not in the tree"""
+        return [pid for pid in sorted(self.stats)
+                if self.parent(pid) not in self.stats]
+
+    def exe(self, pid):
+        try:
+            exe = self.exes[pid]
+        except KeyError:
+            try:
+                exe = getCmdName(pid, False, False, exe_only=True)
+            except LookupError:
+                exe = None
+            self.exes[pid] = exe
+        if exe is None:
+            raise LookupError
+        return exe
+
+
+#return the path of the executable of the process
+def getExe(pid):
+    try:
+        path = proc.readlink(pid, 'exe')
+    except OSError:
+        val = sys.exc_info()[1]
+        if (val.errno == errno.ENOENT or # either kernel thread or process gone
+            val.errno == errno.ESRCH or # process gone
+            val.errno == errno.EPERM or
+            val.errno == errno.EACCES):
+            raise LookupError
+        raise
+    # Some symlink targets were seen to contain NULs on RHEL 5 at least
+    # https://github.com/pixelb/scripts/pull/10, so take string up to NUL
+    return path.split('\0')[0]
+
+
+def getCmdName(pid, split_args, discriminate_by_pid, exe_only=False,
+               name_cache=None, tree=None):
+    def read_cmdline():
+        cmdline = proc.open(pid, 'cmdline').read().split("\0")
+        while cmdline[-1] == '' and len(cmdline) > 1:
+            cmdline = cmdline[:-1]
+        return cmdline
+
+    path = getExe(pid)
+
+    if split_args:
+        return ' '.join(read_cmdline()).replace('\n', ' ')
+    if path.endswith(" (deleted)"):
+        path = path[:-10]
+        if os.path.exists(path):
+            path += " [updated]"
+        else:
+            #The path could be have prelink stuff so try cmdline
+            #which might have the full path present. This helped for:
+            #/usr/libexec/notification-area-applet.#prelink#.fX7LCT (deleted)
+            cmdline = read_cmdline()
+            if os.path.exists(cmdline[0]):
+                path = cmdline[0] + " [updated]"
+            else:
+                path += " [deleted]"
+    exe = os.path.basename(path)
+    if exe_only: return exe
+
+    if tree is not None and pid in tree.stats:
+        cmd = tree.stats[pid][0]
+        ppid = tree.parent(pid)
+    else:
+        proc_status = proc.open(pid, 'status').readlines()
+        cmd = proc_status[0][6:-1]
+        ppid = 0
+        for l in range(10):
+            ps_line = proc_status[l]
+            if ps_line.startswith('PPid:'):
+                ppid = int(ps_line[6:-1])
+                break
+    if exe.startswith(cmd):
+        cmd = exe #show non truncated version
+        #Note because we show the non truncated name
+        #one can have separated programs as follows:
+        #584.0 KiB +   1.0 MiB =   1.6 MiB    mozilla-thunder (exe -> bash)
+        # 56.0 MiB +  22.2 MiB =  78.2 MiB    mozilla-thunderbird-bin
+    else:
+        #Lookup the parent's exe and use that if matching
+        #which will merge "Web Content" with "firefox" for example
+        if ppid:
+            try:
+                if name_cache is not None:
+                    p_exe = name_cache.exe(ppid, tree)
+                elif tree is not None:
+                    p_exe = tree.exe(ppid)
+                else:
+                    p_exe = getCmdName(ppid, False, False, exe_only=True)
+            except LookupError:
+                pass
+            else:
+                if exe == p_exe:
+                    cmd = exe
+    if sys.version_info >= (3,):
+        cmd = cmd.encode(errors='replace').decode()
+    if discriminate_by_pid:
+        cmd = '%s [%d]' % (cmd, pid)
+    return cmd
+
+
+#The following matches "du -h" output
+#see also human.py
+def human(num, power="Ki", units=None):
+    if units is None:
+        powers = ["Ki", "Mi", "Gi", "Ti"]
+        while num >= 1000: #4 digits
+            num /= 1024.0
+            power = powers[powers.index(power)+1]
+        return "%.1f %sB" % (num, power)
+    else:
+        return "%.f" % ((num * 1024) / units)
 
 
 def cmd_with_count(cmd, count):
@@ -388,6 +1793,12 @@ def cmd_with_count(cmd, count):
     else:
         return cmd
 
+
+def ci_human(ci):
+    if ci is None:
+        return "?"  # too few processes examined to estimate
+    return human(ci)
+
 #Warn of possible inaccuracies
 #RAM:
 #2 = accurate & can total
@@ -399,9 +1810,18 @@ def cmd_with_count(cmd, count):
 #1 = accurate only considering each process in isolation
 #-1= not available
 def val_accuracy(show_swap):
+    name = show_swap and 'swap_accuracy' or 'accuracy'
+    if probes is not None and name in probes:
+        return tuple(probes[name])
+    accuracy = probe_accuracy(show_swap)
+    if probes is not None:
+        probes[name] = accuracy
+    return accuracy
+
+def probe_accuracy(show_swap):
     """http://wiki.apache.org/spamassassin/TopSharedMemoryBug"""
     kv = kernel_ver()
-    pid = os.getpid()
+    pid = proc.self_pid
     swap_accuracy = -1
     if kv[:2] == (2,4):
         if proc.open('meminfo').read().find("Inact_") == -1:
@@ -474,39 +1894,257 @@ def show_val_accuracy( ram_inacc, swap_inacc, only_total, show_swap ):
             sys.exit(1)
 
 
+def get_proc_cmd(pid, split_args, discriminate_by_pid, name_cache=None,
+                 group_key=None, stat=None, tree=None):
+    """Return the name of the group (normally the program) for pid"""
+    if group_key is not None:
+        getExe(pid)  # Exclude kernel threads etc. as getCmdName() does
+        return group_key(pid)
+    elif name_cache is None:
+        return getCmdName(pid, split_args, discriminate_by_pid, tree=tree)
+    else:
+        return name_cache.cmd_name(pid, split_args, discriminate_by_pid,
+                                   stat, tree)
+
+
+def get_proc_stats(pid, split_args, discriminate_by_pid, name_cache=None,
+                   stats_cache=None, group_key=None, tree=None):
+    try:
+        with ProcessDir(proc, pid):
+            try:
+                stat = None
+                if tree is not None:
+                    stat = tree.stats[pid]  # KeyError if process gone
+                elif name_cache is not None or stats_cache is not None:
+                    stat = getStat(pid)  # shared between the caches
+                if stat is not None and int(stat[1][STAT_FLAGS]) & PF_KTHREAD:
+                    return None  # without looking up exe
+                cmd = get_proc_cmd(pid, split_args, discriminate_by_pid,
+                                   name_cache, group_key, stat, tree)
+            except LookupError:
+                #operation not permitted
+                #kernel threads don't have exe links or
+                #process gone
+                return None
+
+            if stats_cache is None:
+                return pid, cmd, getMemStats(pid)
+            return pid, cmd, stats_cache.mem_stats(pid, stat)
+    except (LookupError, RuntimeError):
+        return None #process gone
+
+
+def map_jobs(func, items, jobs):
+    # Most of the time reading /proc is spent in the kernel
+    # generating smaps etc. which is done without holding the GIL,
+    # so threads are sufficient to parallelize the collection.
+    # Results are returned in the order of items.
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ProgramUsage(namedtuple('ProgramUsage',
+                              'name private shared swap count pids')):
+    """Memory used by a program (or a process with discriminate_by_pid).
+    Values are in KiB, and pids is a tuple of the processes examined."""
+    __slots__ = ()
+
+    @property
+    def ram(self):
+        return self.private + self.shared
+
+
+class MemoryUsage(object):
+    """Result of get_memory_usage().
+    programs is a list of ProgramUsage, sorted by increasing RAM used.
+    total and total_swap are only meaningful if have_pss and have_swap_pss
+    respectively. ram_accuracy and swap_accuracy are as per val_accuracy(),
+    and are None unless determined by the caller (see Sampler).
+    skipped is None, unless only the top programs were determined,
+    in which case it's the number of processes whose memory wasn't
+    examined, and the totals cover only the programs reported.
+    ram_ci is None, unless the programs were estimated from a sample
+    (see get_sampled_usage()), in which case it's the half width of the
+    95% confidence interval of total, or None if that isn't known.
+    exited is None, unless process events are followed (see ProcEvents),
+    in which case it's a list of ProgramUsage for the processes that
+    started and exited since the previous sample, with the most RAM
+    they were seen to use. These are not included in the totals."""
+    __slots__ = ('programs', 'total', 'total_swap', 'have_pss',
+                 'have_swap_pss', 'ram_accuracy', 'swap_accuracy', 'skipped',
+                 'ram_ci', 'exited')
+
+    def __init__(self, programs, total, total_swap, have_pss, have_swap_pss,
+                 ram_accuracy=None, swap_accuracy=None, skipped=None,
+                 ram_ci=None, exited=None):
+        self.skipped = skipped
+        self.ram_ci = ram_ci
+        self.exited = exited
+        self.programs = programs
+        self.total = total
+        self.total_swap = total_swap
+        self.have_pss = have_pss
+        self.have_swap_pss = have_swap_pss
+        self.ram_accuracy = ram_accuracy
+        self.swap_accuracy = swap_accuracy
+
+
+class ProcessFilter:
+    """Selection of processes that can be passed as pids_to_show.
+    The criteria are checked with "pid in filter" in order of cost,
+    using only cheap sources like the owner of /proc/$pid, comm and statm,
+    so that unselected processes are excluded before being examined."""
+
+    def __init__(self, pids=(), uids=(), comm=None, exe=None, cgroup=None,
+                 min_rss=None):
+        self.pids = set(pids)
+        self.uids = set(uids)
+        self.comm = comm
+        self.exe = exe
+        self.cgroup = cgroup
+        self.cgroups = cgroup is not None and CgroupMemory() or None
+        self.min_rss = min_rss
+
+    def __bool__(self):
+        return True  # selective
+    __nonzero__ = __bool__
+
+    def __contains__(self, pid):
+        if self.pids and pid not in self.pids:
+            return False
+        try:
+            if self.uids and self.uid(pid) not in self.uids:
+                return False
+            if self.comm is not None:
+                comm = proc.open(pid, 'comm').read().rstrip('\n')
+                if not self.comm.search(comm):
+                    return False
+            if self.exe is not None and not self.exe.search(getExe(pid)):
+                return False
+            if (self.cgroup is not None and
+                    not self.cgroup.search(self.cgroups.pid_cgroup(pid))):
+                return False
+            if self.min_rss is not None:
+                rss = int(proc.open(pid, 'statm').readline().split()[1])
+                if rss * PAGESIZE < self.min_rss:
+                    return False
+        except (LookupError, OSError, IOError):
+            return False  # process gone, not permitted or kernel thread
+        return True
+
+    def uid(self, pid):
+        """Return the effective uid of pid. This is the owner of /proc/$pid,
+        except for processes that aren't dumpable (like those that changed
+        uid, e.g. sshd sessions) which are owned by root, in which case
+        the uid is read from status, as it is for another proc root."""
+        uid = os.stat(proc.path(pid)).st_uid
+        if uid != 0 and proc.live:
+            return uid
+        for line in proc.open(pid, 'status'):
+            if line.startswith('Uid:'):
+                return int(line.split()[2])
+        return uid
+
+
+def list_pids(pids_to_show, include_self=False, only_self=False,
+              all_pids=None):
+    """Return the list of selected pids, and the set of all pids.
+    all_pids can be passed to select from rather than listing /proc."""
+    pids = []
+    if all_pids is None:
+        all_pids = set()
+        for pid in os.listdir(proc.path('')):
+            if pid.isdigit():
+                all_pids.add(int(pid))
+    for pid in sorted(all_pids):
+        # Some filters
+        if only_self and pid != proc.self_pid:
+            continue
+        if pid == proc.self_pid and not include_self:
+            continue
+        if pids_to_show and pid not in pids_to_show:
+            continue
+
+        pids.append(pid)
+    return pids, all_pids
+
+
 def get_memory_usage(pids_to_show, split_args, discriminate_by_pid,
-                     include_self=False, only_self=False):
+                     include_self=False, only_self=False, jobs=1,
+                     name_cache=None, stats_cache=None, group_key=None,
+                     events=None):
+    # group_key(pid) can be passed to group processes other than by program,
+    # and events (ProcEvents) to select from its table rather than /proc
+    with profile_phase('list pids'):
+        if events is None:
+            pids, all_pids = list_pids(pids_to_show, include_self, only_self)
+        else:
+            pids, all_pids = events.list_pids(pids_to_show, include_self,
+                                              only_self)
+
+    if name_cache is not None:
+        name_cache.prune(all_pids)
+    if stats_cache is not None:
+        stats_cache.start(all_pids)
+    tree = None
+    if group_key is None:
+        with profile_phase('read stat'):
+            tree = ProcessTree(pids)
+
+    def collect(pid):
+        if profiler is None:
+            return get_proc_stats(pid, split_args, discriminate_by_pid,
+                                  name_cache, stats_cache, group_key, tree)
+        start = timer()
+        stats = get_proc_stats(pid, split_args, discriminate_by_pid,
+                               name_cache, stats_cache, group_key, tree)
+        profiler.add_process(pid, timer() - start, stats)
+        return stats
+
+    with profile_phase('examine processes'):
+        results = [stats for stats in map_jobs(collect, pids, jobs) if stats]
+    with profile_phase('aggregate'):
+        return aggregate_usage(results)
+
+
+def aggregate_usage(results):
+    """Return the MemoryUsage for a list of (pid, cmd, MemStats)"""
     cmds = {}
     shareds = {}
     shared_huges = {}
-    mem_ids = {}
     count = {}
     swaps = {}
-    for pid in os.listdir(proc.path('')):
-        if not pid.isdigit():
-            continue
-        pid = int(pid)
+    cmd_pids = {}
+    have_pss = 0
+    have_swap_pss = 0
+    for pid, cmd, stats in results:
+        have_pss |= stats.have_pss
+        have_swap_pss |= stats.have_swap_pss
 
-        # Some filters
-        if only_self and pid != our_pid:
-            continue
-        if pid == our_pid and not include_self:
-            continue
-        if pids_to_show and pid not in pids_to_show:
-            continue
+    # Processes using CLONE_VM without CLONE_THREAD share an address
+    # space, so only account for one of them. Only processes with the
+    # same command are considered, to limit the comparisons needed.
+    duplicates = VmIdentity(proc).duplicates(
+        [(pid, cmd, stats.mem_id) for pid, cmd, stats in results]
+    )
 
-        try:
-            cmd = getCmdName(pid, split_args, discriminate_by_pid)
-        except LookupError:
-            #operation not permitted
-            #kernel threads don't have exe links or
-            #process gone
+    for pid, cmd, stats in results:
+        if cmd in count:
+            count[cmd] += 1
+        else:
+            count[cmd] = 1
+        cmd_pids.setdefault(cmd, []).append(pid)
+        if pid in duplicates:
             continue
 
-        try:
-            private, shared, shared_huge, swap, mem_id = getMemStats(pid)
-        except RuntimeError:
-            continue #process gone
+        private, shared, shared_huge, swap = stats[:4]
         if shareds.get(cmd):
             if have_pss: #add shared portion of PSS together
                 shareds[cmd] += shared
@@ -520,11 +2158,6 @@ def get_memory_usage(pids_to_show, split_args, discriminate_by_pid,
         else:
             shared_huges[cmd] = shared_huge
         cmds[cmd] = cmds.setdefault(cmd, 0) + private
-        if cmd in count:
-            count[cmd] += 1
-        else:
-            count[cmd] = 1
-        mem_ids.setdefault(cmd, {}).update({mem_id: None})
 
         # Swap (overcounting for now...)
         swaps[cmd] = swaps.setdefault(cmd, 0) + swap
@@ -536,13 +2169,6 @@ def get_memory_usage(pids_to_show, split_args, discriminate_by_pid,
     total = 0
 
     for cmd in cmds:
-        cmd_count = count[cmd]
-        if len(mem_ids[cmd]) == 1 and cmd_count > 1:
-            # Assume this program is using CLONE_VM without CLONE_THREAD
-            # so only account for one of the processes
-            cmds[cmd] /= cmd_count
-            if have_pss:
-                shareds[cmd] /= cmd_count
         # overestimation possible if shared_huges shared across commands
         shareds[cmd] += shared_huges[cmd]
         cmds[cmd] = cmds[cmd] + shareds[cmd]
@@ -550,117 +2176,2238 @@ def get_memory_usage(pids_to_show, split_args, discriminate_by_pid,
         total_swap += swaps[cmd]
 
     sorted_cmds = sorted(cmds.items(), key=lambda x:x[1])
-    sorted_cmds = [x for x in sorted_cmds if x[1]]
+    programs = [ProgramUsage(cmd, ram - shareds[cmd], shareds[cmd],
+                             swaps[cmd], count[cmd], tuple(cmd_pids[cmd]))
+                for cmd, ram in sorted_cmds if ram]
 
-    return sorted_cmds, shareds, count, total, swaps, total_swap
+    return MemoryUsage(programs, total, total_swap, have_pss, have_swap_pss)
 
-def print_header(show_swap, discriminate_by_pid):
-    output_string = " Private  +   Shared  =  RAM used"
-    if show_swap:
-        output_string += "   Swap used"
-    output_string += "\tProgram"
-    if discriminate_by_pid:
-        output_string += "[pid]"
-    output_string += "\n\n"
-    sys.stdout.write(output_string)
 
+def get_top_usage(pids_to_show, split_args, discriminate_by_pid, top,
+                  include_self=False, jobs=1, name_cache=None,
+                  group_key=None):
+    """Return the MemoryUsage of the top programs by RAM used.
+    The RSS from /proc/$pid/statm is an upper bound of the RAM used
+    by a process, so smaps is only read for programs whose total RSS
+    could place them in the top. Note hugetlb pages are not included
+    in RSS, so programs mostly using those could be missed."""
+    pids, all_pids = list_pids(pids_to_show, include_self)
+    if name_cache is not None:
+        name_cache.prune(all_pids)
 
-def print_memory_usage(sorted_cmds, shareds, count, total, swaps, total_swap,
-                       show_swap):
-    for cmd in sorted_cmds:
+    def collect_rss(pid):
+        try:
+            with ProcessDir(proc, pid):
+                cmd = get_proc_cmd(pid, split_args, discriminate_by_pid,
+                                   name_cache, group_key)
+                rss = (int(proc.open(pid, 'statm').readline().split()[1])
+                       * PAGESIZE)
+        except LookupError:
+            return None
+        return pid, cmd, rss
 
-        output_string = "%9s + %9s = %9s"
-        output_data = (human(cmd[1]-shareds[cmd[0]]),
-                       human(shareds[cmd[0]]), human(cmd[1]))
-        if show_swap:
-            output_string += "   %9s"
-            output_data += (human(swaps[cmd[0]]),)
-        output_string += "\t%s\n"
-        output_data += (cmd_with_count(cmd[0], count[cmd[0]]),)
+    bounds = {}
+    cmd_pids = {}
+    for result in map_jobs(collect_rss, pids, jobs):
+        if result is not None:
+            pid, cmd, rss = result
+            bounds[cmd] = bounds.get(cmd, 0) + rss
+            cmd_pids.setdefault(cmd, []).append((pid, cmd))
 
-        sys.stdout.write(output_string % output_data)
+    def collect_stats(pid_cmd):
+        try:
+            with ProcessDir(proc, pid_cmd[0]):
+                return pid_cmd + (getMemStats(pid_cmd[0]),)
+        except (LookupError, RuntimeError):
+            return None #process gone
 
-    # Only show totals if appropriate
-    if have_swap_pss and show_swap:  # kernel will have_pss
-        sys.stdout.write("%s\n%s%9s%s%9s\n%s\n" %
-                         ("-" * 45, " " * 24, human(total), " " * 3,
-                          human(total_swap), "=" * 45))
-    elif have_pss:
-        sys.stdout.write("%s\n%s%9s\n%s\n" %
-                         ("-" * 33, " " * 24, human(total), "=" * 33))
+    heap = []  # (RAM used, name, ProgramUsage) of the top programs
+    skipped = sum(len(cmd_pids[cmd]) for cmd in cmd_pids)
+    have_pss = have_swap_pss = 0
+    for cmd in sorted(bounds, key=bounds.get, reverse=True):
+        if len(heap) == top and bounds[cmd] <= heap[0][0]:
+            break  # this and all remaining programs can't be in the top
+        results = map_jobs(collect_stats, cmd_pids[cmd], jobs)
+        skipped -= len(cmd_pids[cmd])
+        usage = aggregate_usage([result for result in results if result])
+        have_pss |= usage.have_pss
+        have_swap_pss |= usage.have_swap_pss
+        for program in usage.programs:
+            if len(heap) < top:
+                heapq.heappush(heap, (program.ram, program.name, program))
+            else:
+                heapq.heappushpop(heap, (program.ram, program.name, program))
 
+    programs = [program for ram, name, program in sorted(heap)]
+    return MemoryUsage(programs, sum(program.ram for program in programs),
+                       sum(program.swap for program in programs),
+                       have_pss, have_swap_pss, skipped=skipped)
 
-def verify_environment(pids_to_show):
-    if os.geteuid() != 0 and not pids_to_show:
-        sys.stderr.write("Sorry, root permission required, or specify pids with -p\n")
-        sys.stderr.close()
-        sys.exit(1)
 
-    try:
-        kernel_ver()
-    except (IOError, OSError):
-        val = sys.exc_info()[1]
-        if val.errno == errno.ENOENT:
-            sys.stderr.write(
-              "Couldn't access " + proc.path('') + "\n"
-              "Only GNU/Linux and FreeBSD (with linprocfs) are supported\n")
-            sys.exit(2)
-        else:
-            raise
+# Fields needed from /proc/$pid/smaps_rollup by get_total_usage()
+smaps_total_re = re.compile(
+    br'\n(Pss|SwapPss|Private_Hugetlb|Shared_Hugetlb):[ \t]*([0-9]+)'
+)
 
-def main():
-    # Force the stdout and stderr streams to be unbuffered
-    sys.stdout = Unbuffered(sys.stdout)
-    sys.stderr = Unbuffered(sys.stderr)
+def get_total_usage(pids_to_show, include_self=False, jobs=1):
+    """Return a MemoryUsage with just the totals (and no programs) for the
+    selected processes. This only reads /proc/$pid/smaps_rollup,
+    so requires a kernel providing that (Linux >= 4.14).
+    None is returned if any process has shared hugetlb pages, as these
+    are accounted per program, so need the programs to be determined."""
+    pids = list_pids(pids_to_show, include_self)[0]
+
+    def collect(pid):
+        try:
+            f = proc.open_binary(pid, 'smaps_rollup')
+        except LookupError:
+            return None  # process gone or not permitted
+        try:
+            data = read_bytes(f)
+        finally:
+            f.close()
+        fields = {}
+        for match in smaps_total_re.finditer(data):
+            field, value = match.groups()
+            fields[field] = int(value)
+        if not fields:
+            return None  # kernel thread
+        # The rollup of processes sharing an address space through
+        # CLONE_VM is identical, so is used to fingerprint the address space
+        header = first_line_re.match(data).group()
+        return pid, (header, tuple(sorted(fields.items()))), fields
 
-    split_args, pids_to_show, watch, only_total, discriminate_by_pid, \
-    show_swap = parse_options()
+    results = [stats for stats in map_jobs(collect, pids, jobs) if stats]
+    duplicates = VmIdentity(proc).duplicates(
+        [(pid, None, mem_id) for pid, mem_id, fields in results]
+    )
 
-    verify_environment(pids_to_show)
+    total = total_swap = 0
+    have_pss = have_swap_pss = 0
+    for pid, mem_id, fields in results:
+        if pid in duplicates:
+            continue
+        if fields.get(b'Shared_Hugetlb'):
+            return None
+        if b'Pss' in fields:
+            have_pss = 1
+            # add 0.5KiB as this avg error due to truncation
+            total += fields[b'Pss'] + 0.5
+        total += fields.get(b'Private_Hugetlb', 0)
+        if b'SwapPss' in fields:
+            have_swap_pss = 1
+            total_swap += fields[b'SwapPss']
 
-    if not only_total:
-        print_header(show_swap, discriminate_by_pid)
+    return MemoryUsage([], total, total_swap, have_pss, have_swap_pss)
 
-    if watch is not None:
-        try:
-            sorted_cmds = True
-            while sorted_cmds:
-                sorted_cmds, shareds, count, total, swaps, total_swap = \
-                    get_memory_usage(pids_to_show, split_args,
-                                     discriminate_by_pid)
-                if only_total and show_swap and have_swap_pss:
-                    sys.stdout.write(human(total_swap, units=1)+'\n')
-                elif only_total and not show_swap and have_pss:
-                    sys.stdout.write(human(total, units=1)+'\n')
-                elif not only_total:
-                    print_memory_usage(sorted_cmds, shareds, count, total,
-                                       swaps, total_swap, show_swap)
 
-                sys.stdout.flush()
-                time.sleep(watch)
+def get_tree_usage(pids_to_show, split_args, depth=-1, include_self=False,
+                   jobs=1):
+    """Return a MemoryUsage with an entry per process in the process tree,
+    in depth first order with the name indented by depth, and the values
+    for each the totals over its subtree. If depth is not negative,
+    descendants deeper than depth are included in their ancestor
+    at that depth. The pids of each entry are those of its subtree."""
+    pids, all_pids = list_pids(pids_to_show, include_self)
+    tree = ProcessTree(all_pids)
+
+    def collect(pid):
+        return get_proc_stats(pid, split_args, False, tree=tree)
+
+    results = [stats for stats in map_jobs(collect, pids, jobs) if stats]
+    # Processes sharing an address space are only accounted once
+    duplicates = VmIdentity(proc).duplicates(
+        [(pid, cmd, stats.mem_id) for pid, cmd, stats in results]
+    )
+    have_pss = have_swap_pss = 0
+    names = {}
+    values = {}  # pid -> [private, shared, swap, count, pids] of subtree
+    for pid in tree.stats:
+        values[pid] = [0, 0, 0, 0, []]
+    for pid, cmd, stats in results:
+        have_pss |= stats.have_pss
+        have_swap_pss |= stats.have_swap_pss
+        names[pid] = cmd
+        node = values[pid]
+        node[3] = 1
+        node[4].append(pid)
+        if pid not in duplicates:
+            node[0] = stats.private
+            node[1] = stats.shared + stats.shared_huge
+            node[2] = stats.swap
+
+    # Visit depth first, then accumulate in reverse so children
+    # are added to their parent before it is added to its own parent
+    children = tree.children()
+    order = []
+    stack = [(pid, 0) for pid in reversed(tree.roots())]
+    while stack:
+        pid, level = stack.pop()
+        order.append((pid, level))
+        stack.extend((child, level + 1)
+                     for child in reversed(children.get(pid, ())))
+    for pid, level in reversed(order):
+        ppid = tree.parent(pid)
+        if ppid in values:
+            parent, node = values[ppid], values[pid]
+            for index in range(4):
+                parent[index] += node[index]
+            parent[4].extend(node[4])
+
+    def ram(pid):
+        return values[pid][0] + values[pid][1]
+
+    programs = []
+    stack = [(pid, 0) for pid in sorted(tree.roots(), key=ram)]
+    while stack:
+        pid, level = stack.pop()
+        private, shared, swap, count, subtree = values[pid]
+        if not count:
+            continue  # no (accessible) processes with memory
+        name = names.get(pid) or tree.stats[pid][0]
+        programs.append(ProgramUsage('  ' * level + '%s [%d]' % (name, pid),
+                                     private, shared, swap, count,
+                                     tuple(sorted(subtree))))
+        if depth < 0 or level < depth:
+            stack.extend((child, level + 1)
+                         for child in sorted(children.get(pid, ()), key=ram))
+
+    roots = [values[pid] for pid in tree.roots()]
+    total = sum(node[0] + node[1] for node in roots)
+    total_swap = sum(node[2] for node in roots)
+    return MemoryUsage(programs, total, total_swap, have_pss, have_swap_pss)
+
+
+# Normal quantile for the 95% confidence intervals of sampled estimates
+SAMPLE_Z = 1.96
+# Groups of at most this many processes are always measured exactly
+SAMPLE_SMALL_GROUP = 4
+
+class SampledProgramUsage(namedtuple('SampledProgramUsage',
+                                     ProgramUsage._fields +
+                                     ('sampled', 'ram_ci'))):
+    """Estimated memory used by a program, from a sample of its processes.
+    sampled is the number of processes examined, and ram_ci the half
+    width of the 95% confidence interval of ram, or None if unknown."""
+    __slots__ = ()
+    ram = ProgramUsage.ram
+
+
+def sample_order(strata, rng):
+    """Return the pids of strata {name: [(pid, rss)]} in the order to
+    examine them, such that any prefix is a sample of each stratum in
+    proportion to its total RSS, with at least 2 processes where possible
+    (as needed to estimate the variance)"""
+    heap = []
+    members = {}
+    for name, processes in strata.items():
+        processes = list(processes)
+        rng.shuffle(processes)
+        weight = float(sum(rss for pid, rss in processes))
+        members[name] = (processes, weight)
+        heap.append(((0, 0, -weight), name))
+    heapq.heapify(heap)
+    order = []
+    while heap:
+        key, name = heapq.heappop(heap)
+        processes, weight = members[name]
+        taken = key[1] if key[0] == 0 else key[2]
+        order.append(processes[taken][0])
+        taken += 1
+        if taken < len(processes):
+            if taken < 2:
+                key = (0, taken, -weight)
             else:
-                sys.stdout.write('Process does not exist anymore.\n')
-        except KeyboardInterrupt:
-            pass
-    else:
-        # This is the default behavior
-        sorted_cmds, shareds, count, total, swaps, total_swap = \
-            get_memory_usage(pids_to_show, split_args,
-                             discriminate_by_pid)
-        if only_total and show_swap and have_swap_pss:
-            sys.stdout.write(human(total_swap, units=1)+'\n')
-        elif only_total and not show_swap and have_pss:
-            sys.stdout.write(human(total, units=1)+'\n')
-        elif not only_total:
-            print_memory_usage(sorted_cmds, shareds, count, total, swaps,
-                               total_swap, show_swap)
+                key = (1, taken / weight, taken)
+            heapq.heappush(heap, (key, name))
+    return order
+
+
+def get_sampled_usage(pids_to_show, size=None, seconds=None,
+                      include_self=False, jobs=1):
+    """Return a MemoryUsage of SampledProgramUsage estimated from a sample
+    of at most size processes, or as many as can be examined in seconds.
+    Processes are grouped (stratified) by comm, and the RSS of every process
+    is read from its stat, so the ram of each group is estimated as the
+    ratio of ram to RSS of the sample times the RSS of all its processes.
+    Groups of at most SAMPLE_SMALL_GROUP processes are examined first,
+    in addition to the sample of the other groups, and are measured exactly
+    as are other groups with all processes examined."""
+    deadline = seconds is not None and timer() + seconds
+    pids = list_pids(pids_to_show, include_self)[0]
+    tree = ProcessTree(pids)
+    strata = {}  # comm -> [(pid, rss)]
+    for pid, (comm, fields) in tree.stats.items():
+        rss = int(fields[STAT_RSS]) * PAGESIZE
+        if rss:  # kernel threads and zombies have no memory
+            strata.setdefault(comm, []).append((pid, rss))
+
+    small = [pid for processes in strata.values()
+             if len(processes) <= SAMPLE_SMALL_GROUP
+             for pid, rss in processes]
+    order = sample_order(dict((comm, processes)
+                              for comm, processes in strata.items()
+                              if len(processes) > SAMPLE_SMALL_GROUP),
+                         random.Random())
+    if size is not None:
+        order = order[:max(size - len(small), 0)]
+    order = small + order
+
+    def collect(pid):
+        try:
+            with ProcessDir(proc, pid):
+                return pid, getMemStats(pid)
+        except (LookupError, RuntimeError):
+            return pid, None  # process gone or not permitted
+
+    measured = {}  # pid -> MemStats or None
+    batch = max(jobs, 1) * 4
+    for start in range(0, len(order), batch):
+        if deadline and start >= len(small) and timer() > deadline:
+            break
+        measured.update(map_jobs(collect, order[start:start + batch], jobs))
+
+    have_pss = have_swap_pss = 0
+    total_rss = total_ram = total_swap = 0  # over all processes examined
+    for stats in measured.values():
+        if stats is not None:
+            have_pss |= stats.have_pss
+            have_swap_pss |= stats.have_swap_pss
+    examined = {}  # comm -> [(rss, MemStats)]
+    for comm, processes in strata.items():
+        # Processes that couldn't be examined are excluded, as in full scans
+        strata[comm] = [(pid, rss) for pid, rss in processes
+                        if measured.get(pid, True) is not None]
+        examined[comm] = [(rss, measured[pid]) for pid, rss in processes
+                          if measured.get(pid) is not None]
+        for rss, stats in examined[comm]:
+            total_rss += rss
+            total_ram += stats.private + stats.shared + stats.shared_huge
+            total_swap += stats.swap
+    sample_count = sum(len(sample) for sample in examined.values())
+
+    programs = []
+    for comm, processes in strata.items():
+        sample = examined[comm]
+        N, n = len(processes), len(sample)
+        if not N:
+            continue
+        rss_all = sum(rss for pid, rss in processes)
+        private = sum(stats.private for rss, stats in sample)
+        shared = sum(stats.shared + stats.shared_huge for rss, stats in sample)
+        swap = sum(stats.swap for rss, stats in sample)
+        ci = None
+        if n == N:
+            # Measured exactly, accounting once for shared address spaces
+            exact = aggregate_usage([(pid, comm, measured[pid])
+                                     for pid, rss in processes]).programs[0]
+            private, shared, swap = exact.private, exact.shared, exact.swap
+            ci = 0
+        elif n:
+            rss_sample = float(sum(rss for rss, stats in sample))
+            scale = rss_all / rss_sample
+            if n > 1:
+                ratio = (private + shared) / rss_sample
+                residuals = sum((stats.private + stats.shared +
+                                 stats.shared_huge - ratio * rss) ** 2
+                                for rss, stats in sample)
+                variance = (N * N * (1.0 - float(n) / N) / n *
+                            residuals / (n - 1))
+                ci = SAMPLE_Z * variance ** 0.5
+            private *= scale
+            shared *= scale
+            swap *= float(N) / n
+        elif total_rss:
+            # Nothing examined in time, so use the ratios over all groups
+            private = rss_all * float(total_ram) / total_rss
+            shared = 0
+            swap = N * float(total_swap) / sample_count
+        else:
+            continue
+        programs.append(SampledProgramUsage(
+            comm, private, shared, swap, N,
+            tuple(sorted(pid for pid, rss in processes)), n, ci))
+
+    programs.sort(key=lambda program: program.ram)
+    total = sum(program.ram for program in programs)
+    total_swap = sum(program.swap for program in programs)
+    ram_ci = None
+    if all(program.ram_ci is not None for program in programs):
+        # The groups are sampled independently, so variances add
+        ram_ci = sum(program.ram_ci ** 2 for program in programs) ** 0.5
+    return MemoryUsage(programs, total, total_swap, have_pss, have_swap_pss,
+                       ram_ci=ram_ci)
+
+
+class WatchSchedule:
+    """Schedule of samples in watch mode, every interval seconds.
+    If fast is given, memory pressure is polled every fast seconds between
+    samples, from the time stalled on memory per /proc/pressure/memory
+    (PSI) and MemAvailable in /proc/meminfo. While the stall exceeds
+    pressure percent, or MemAvailable is below available percent of
+    MemTotal, samples are every fast seconds instead, and immediately when
+    the pressure reaches a new peak. If max_cpu is given, samples are
+    delayed as needed to limit the CPU time used to max_cpu percent."""
+
+    def __init__(self, interval, fast=None, pressure=10, available=10,
+                 max_cpu=None):
+        self.interval = interval
+        self.fast = fast
+        self.pressure = pressure
+        self.available = available
+        self.max_cpu = max_cpu
+        self.stall = None  # (total stall us, time) as last polled
+        self.episode = False  # whether under pressure
+        self.peak = None  # (severity, time, stall, available, usage)
+        self.severity = None  # of the sample being taken
+        self.condition = None  # (stall, available) of the sample
+        self.waiting = None  # time the wait for the next sample started
+        self.start()
+
+    @staticmethod
+    def cpu():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def start(self):
+        self.sample_time = timer()
+        self.sample_cpu = self.cpu()
+
+    def poll(self):
+        """Return the percentage of time stalled on memory since the last
+        poll, and the percentage of memory available, or None for either
+        if not provided by the kernel"""
+        stall = available = None
+        try:
+            for line in proc.open('pressure/memory'):
+                if line.startswith('some '):
+                    fields = dict(field.split('=') for field in line.split()[1:])
+                    total, now = int(fields['total']), timer()
+                    if self.stall is None:
+                        stall = float(fields['avg10'])
+                    else:
+                        stall = ((total - self.stall[0]) /
+                                 ((now - self.stall[1]) * 1e4))
+                    self.stall = total, now
+        except (IOError, OSError):
+            pass  # PSI not supported or not enabled
+        meminfo = {}
+        for line in proc.open('meminfo'):
+            name, value = line.split(':', 1)
+            meminfo[name] = value
+        if 'MemAvailable' in meminfo:
+            available = (100.0 * int(meminfo['MemAvailable'].split()[0]) /
+                         int(meminfo['MemTotal'].split()[0]))
+        return stall, available
+
+    def wait(self):
+        """Wait until the next sample is due, returning None. If a period
+        of memory pressure ends in the meantime, return the peak of it
+        as (time, stall, available, usage) instead, and wait again
+        when called again."""
+        if self.waiting is None:
+            self.waiting = timer()
+        # Intervals are from the end of the previous sample (and report)
+        earliest = self.waiting
+        if self.max_cpu:
+            earliest = max(earliest, self.sample_time +
+                           (self.cpu() - self.sample_cpu) * 100.0 /
+                           self.max_cpu)
+        while True:
+            now = timer()
+            due = max(self.waiting + self.interval, earliest)
+            if self.fast:
+                stall, available = self.poll()
+                # Pressure can be 0 with thresholds of 0,
+                # so whether under pressure is tracked separately
+                pressed = False
+                severity = 0
+                if stall is not None and stall >= self.pressure:
+                    pressed = True
+                    severity = stall
+                if available is not None and available <= self.available:
+                    pressed = True
+                    severity = max(severity, 100 - available)
+                if pressed:
+                    if not self.episode:
+                        self.episode = True
+                        self.peak = None
+                    due = max(self.waiting + self.fast, earliest)
+                    if self.peak is None or severity > self.peak[0]:
+                        due = max(now, earliest)
+                elif self.episode:
+                    self.episode = False
+                    if self.peak is not None:
+                        return self.peak[1:]
+                self.severity = severity
+                self.condition = stall, available
+            if now >= due:
+                break
+            time.sleep(min(self.fast or due - now, due - now))
+        self.waiting = None
+        self.start()
+        return None
+
+    def sampled(self, usage):
+        """Note the usage sampled after wait() returned None"""
+        if self.episode and (self.peak is None
+                             or self.severity > self.peak[0]):
+            self.peak = ((self.severity, time.time()) + self.condition +
+                         (usage,))
+
+
+class Sampler:
+    """Sample memory usage per program, suitable for repeated use
+    in a long running process. State to make subsequent samples cheaper
+    is maintained per Sampler instance, rather than globally.
+
+        sampler = ps_mem.Sampler()
+        for program in sampler.sample().programs:
+            print(program.name, program.ram)
+    """
+
+    def __init__(self, pids_to_show=(), split_args=False,
+                 discriminate_by_pid=False, include_self=False,
+                 only_self=False, jobs=1, cache_names=True,
+                 incremental=None, group_key=None, only_total=False,
+                 top=None, sample_size=None, sample_time=None, events=None):
+        self.pids_to_show = pids_to_show
+        self.events = events
+        self.sample_size = sample_size
+        self.sample_time = sample_time
+        self.top = top
+        self.only_total = only_total
+        self.rollup = None
+        self.group_key = group_key
+        self.split_args = split_args
+        self.discriminate_by_pid = discriminate_by_pid
+        self.include_self = include_self
+        self.only_self = only_self
+        self.jobs = jobs
+        self.name_cache = None
+        if cache_names:
+            self.name_cache = NameCache()
+        self.stats_cache = None
+        if incremental:
+            self.stats_cache = StatsCache(incremental)
+        elif events is not None:
+            # Avoid reading smaps of all processes each iteration,
+            # as is avoided for listing them
+            self.stats_cache = StatsCache(EVENT_REFRESH)
+        self.accuracy = None
+
+    def sample(self):
+        if profiler is not None:
+            profiler.samples += 1
+        if self.sample_size or self.sample_time:
+            with profile_phase('sample scan'):
+                usage = get_sampled_usage(self.pids_to_show,
+                                          self.sample_size, self.sample_time,
+                                          include_self=self.include_self,
+                                          jobs=self.jobs)
+            return self.with_accuracy(usage)
+
+        if self.only_total and self.rollup is None:
+            # Probe the kernel once for smaps_rollup support
+            self.rollup = (proc.self_pid is not None and
+                           proc.smaps_file(proc.self_pid) == 'smaps_rollup')
+        if self.only_total and self.rollup and not self.only_self:
+            with profile_phase('total scan'):
+                usage = get_total_usage(self.pids_to_show,
+                                        include_self=self.include_self,
+                                        jobs=self.jobs)
+            if usage is not None and usage.have_pss:
+                # The accuracy is as per the fields read
+                self.accuracy = (2, usage.have_swap_pss and 2 or 1)
+                usage.ram_accuracy, usage.swap_accuracy = self.accuracy
+                return usage
+            if usage is not None:
+                return self.with_accuracy(usage)  # nothing examined
+
+        if self.top:
+            with profile_phase('top scan'):
+                usage = get_top_usage(self.pids_to_show, self.split_args,
+                                      self.discriminate_by_pid, self.top,
+                                      include_self=self.include_self,
+                                      jobs=self.jobs,
+                                      name_cache=self.name_cache,
+                                      group_key=self.group_key)
+        else:
+            if self.events is not None:
+                # Entries may be valid for the previous program of a pid
+                for pid in self.events.take_changed():
+                    if self.name_cache is not None:
+                        self.name_cache.names.pop(pid, None)
+                        self.name_cache.exes.pop(pid, None)
+                    if self.stats_cache is not None:
+                        self.stats_cache.stats.pop(pid, None)
+            usage = get_memory_usage(self.pids_to_show, self.split_args,
+                                     self.discriminate_by_pid,
+                                     include_self=self.include_self,
+                                     only_self=self.only_self,
+                                     jobs=self.jobs,
+                                     name_cache=self.name_cache,
+                                     stats_cache=self.stats_cache,
+                                     group_key=self.group_key,
+                                     events=self.events)
+            if self.events is not None:
+                usage.exited = aggregate_usage(
+                    self.events.take_exited()).programs
+        return self.with_accuracy(usage)
+
+    def with_accuracy(self, usage):
+        if self.accuracy is None:
+            # This is a property of the kernel, so only probe once
+            with profile_phase('accuracy probe'):
+                self.accuracy = val_accuracy(show_swap=True)
+        usage.ram_accuracy, usage.swap_accuracy = self.accuracy
+        return usage
+
+
+# Mapping headers and fields of interest from /proc/$pid/smaps.
+# Note the first line is a mapping header not preceded by a newline,
+# which is matched separately with smaps_header_re.
+smaps_header_re = re.compile(
+    br'[0-9a-f]+-[0-9a-f]+ \S+ [0-9a-f]+ ([0-9a-f]+:[0-9a-f]+) ([0-9]+) *([^\n]*)'
+)
+smaps_mapping_re = re.compile(
+    br'\n(?:[0-9a-f]+-[0-9a-f]+ \S+ [0-9a-f]+ ([0-9a-f]+:[0-9a-f]+) ([0-9]+)'
+    br' *([^\n]*)|(Pss|SwapPss|Swap|Shared\w*|Private\w*):[ \t]*([0-9]+))'
+)
+
+# Indexes of the values accumulated per mapped object by getMappingStats()
+MAP_PSS = 0
+MAP_PRIVATE = 1
+MAP_SHARED = 2
+MAP_PRIVATE_HUGE = 3
+MAP_SHARED_HUGE = 4
+MAP_SWAP = 5
+MAP_SWAP_PSS = 6
+MAP_COUNT = 7  # number of processes, in the totals over all processes
+
+
+def mapping_key(dev, inode, path):
+    # Mappings of the same file are identified by device and inode,
+    # while anonymous mappings are identified by name alone
+    # ([heap], [stack], etc. or '' for other anonymous memory).
+    if inode != b'0':
+        return dev, inode, path
+    if path.startswith(b'[stack'):
+        return b'[stack]'  # [stack:tid] on older kernels
+    return path
+
+
+def getMappingStats(pid):
+    """Return {mapped object: [values indexed by MAP_*]} for the process,
+    summed in a single pass over its smaps"""
+    f = proc.open_binary(pid, 'smaps')
+    try:
+        data = read_bytes(f)
+    finally:
+        f.close()
+    objects = {}
+    header = smaps_header_re.match(data)
+    if not header:
+        return objects
+    values = objects.setdefault(mapping_key(*header.groups()), [0] * 7)
+    for match in smaps_mapping_re.finditer(data):
+        dev, inode, path, field, value = match.groups()
+        if field is None:
+            key = mapping_key(dev, inode, path)
+            values = objects.get(key)
+            if values is None:
+                values = objects[key] = [0] * 7
+        elif field == b'Pss':
+            if value != b'0':
+                # add 0.5KiB as this avg error due to truncation
+                values[MAP_PSS] += int(value) + 0.5
+        elif field == b'Private_Hugetlb':
+            values[MAP_PRIVATE_HUGE] += int(value)
+        elif field == b'Shared_Hugetlb':
+            values[MAP_SHARED_HUGE] += int(value)
+        elif field.startswith(b'Private'):
+            values[MAP_PRIVATE] += int(value)
+        elif field.startswith(b'Shared'):
+            values[MAP_SHARED] += int(value)
+        elif field == b'Swap':
+            values[MAP_SWAP] += int(value)
+        else:
+            values[MAP_SWAP_PSS] += int(value)
+    return objects
+
+
+def get_mapping_usage(pids_to_show, include_self=False, jobs=1):
+    """Return a MemoryUsage with an entry per mapped object (file, [heap],
+    [stack], etc.) over the selected processes, rather than per program.
+    The count of each entry is the number of processes mapping it."""
+    pids = list_pids(pids_to_show, include_self)[0]
+
+    def collect(pid):
+        try:
+            return getMappingStats(pid)
+        except LookupError:
+            return None  # process gone or not permitted
+
+    totals = {}  # mapped object -> MAP_* values
+    for objects in map_jobs(collect, pids, jobs):
+        for key, values in (objects or {}).items():
+            total = totals.get(key)
+            if total is None:
+                totals[key] = values + [1]  # MAP_COUNT
+                continue
+            for index in (MAP_PSS, MAP_PRIVATE, MAP_PRIVATE_HUGE,
+                          MAP_SWAP, MAP_SWAP_PSS):
+                total[index] += values[index]
+            # Shared pages of an object are largely the same pages
+            # in each process, so just take the largest without PSS
+            for index in (MAP_SHARED, MAP_SHARED_HUGE):
+                if total[index] < values[index]:
+                    total[index] = values[index]
+            total[MAP_COUNT] += 1
+
+    have_pss = any(total[MAP_PSS] for total in totals.values())
+    have_swap_pss = any(total[MAP_SWAP_PSS] for total in totals.values())
+    programs = []
+    for key, total in totals.items():
+        if isinstance(key, tuple):
+            dev, inode, name = key
+            if total[MAP_PRIVATE_HUGE] or total[MAP_SHARED_HUGE]:
+                name = b'[hugetlb] ' + name
+            elif name.startswith((b'/SYSV', b'/dev/shm/', b'/memfd:')):
+                name = b'[shm] ' + name
+        else:
+            name = key or b'[anon]'
+        if sys.version_info >= (3,):
+            name = name.decode(errors='replace')
+        private = total[MAP_PRIVATE] + total[MAP_PRIVATE_HUGE]
+        shared = total[MAP_SHARED]
+        if have_pss:
+            shared = total[MAP_PSS] - total[MAP_PRIVATE]
+        shared += total[MAP_SHARED_HUGE]
+        if have_swap_pss:
+            swap = total[MAP_SWAP_PSS]
+        else:
+            swap = total[MAP_SWAP]
+        if private + shared:
+            programs.append(ProgramUsage(name, private, shared, swap,
+                                         total[MAP_COUNT], ()))
+    programs.sort(key=lambda program: program.ram)
+    total = sum(program.ram for program in programs)
+    total_swap = sum(program.swap for program in programs)
+    return MemoryUsage(programs, total, total_swap, have_pss, have_swap_pss)
+
+
+#
+#   Exact accounting of the physical pages used by each program.
+#   The page frames mapped by each process are read from /proc/$pid/pagemap,
+#   and the number of mappings of each frame from /proc/kpagecount,
+#   so that frames used only by a program can be distinguished from
+#   those shared with other programs. This requires root (CAP_SYS_ADMIN)
+#   and is done in bulk with numpy if available.
+#
+
+PM_PRESENT = 1 << 63
+PM_PFN_MASK = (1 << 55) - 1
+KPF_NOPAGE = 1 << 20  # not backed by a page, like device memory
+KPF_ZERO_PAGE = 1 << 24  # the (huge) zero page, not attributable
+PAGEMAP_CHUNK = 64 * 1024  # pagemap entries read at a time
+FRAME_BLOCK_SHIFT = 12  # kpagecount/kpageflags read in blocks of frames
+
+vma_re = re.compile(
+    br'(?:^|\n)([0-9a-f]+)-([0-9a-f]+) '
+    br'|\n(?:Rss|Private_Hugetlb|Shared_Hugetlb):[ \t]*([0-9]+)'
+)
+
+def pagemap_frames(data):
+    """Return the page frame numbers of the present pages in pagemap data"""
+    if numpy is not None:
+        entries = numpy.frombuffer(data, dtype=numpy.uint64)
+        entries = entries[entries >= numpy.uint64(PM_PRESENT)]
+        frames = entries & numpy.uint64(PM_PFN_MASK)
+        return frames[frames != 0]
+    entries = struct.unpack('%dQ' % (len(data) // 8), data)
+    return [entry & PM_PFN_MASK for entry in entries
+            if entry & PM_PRESENT and entry & PM_PFN_MASK]
+
+def count_frames(frames):
+    """Return the sorted unique frames of the list of frame arrays,
+    and the number of occurrences of each"""
+    if numpy is not None:
+        if not frames:
+            return (numpy.zeros(0, dtype=numpy.uint64),
+                    numpy.zeros(0, dtype=numpy.int64))
+        return numpy.unique(numpy.concatenate(frames), return_counts=True)
+    counts = {}
+    for chunk in frames:
+        for frame in chunk:
+            counts[frame] = counts.get(frame, 0) + 1
+    unique = sorted(counts)
+    return unique, [counts[frame] for frame in unique]
+
+def read_frame_values(name, frames):
+    """Return the 64 bit values from /proc/$name (kpagecount or
+    kpageflags) for the sorted frames. This is read in blocks
+    of frames, to avoid reading the whole table for large memories."""
+    block_size = 1 << FRAME_BLOCK_SHIFT
+    f = proc.open_binary(name)
+    try:
+        if numpy is not None:
+            values = numpy.zeros(len(frames), dtype=numpy.uint64)
+            blocks = numpy.unique(frames >> numpy.uint64(FRAME_BLOCK_SHIFT))
+            bounds = numpy.searchsorted(
+                frames, numpy.append(blocks, blocks[-1:] + 1)
+                        << numpy.uint64(FRAME_BLOCK_SHIFT))
+            for i, block in enumerate(blocks):
+                start = int(block) * block_size
+                f.seek(start * 8)
+                table = numpy.frombuffer(f.read(block_size * 8),
+                                         dtype=numpy.uint64)
+                # Frames beyond the end of the table are left as 0
+                index = (frames[bounds[i]:bounds[i + 1]].astype(numpy.int64)
+                         - start)
+                found = index < len(table)
+                values[bounds[i]:bounds[i + 1]][found] = table[index[found]]
+            return values
+        values = []
+        block = table = None
+        for frame in frames:
+            if frame >> FRAME_BLOCK_SHIFT != block:
+                block = frame >> FRAME_BLOCK_SHIFT
+                f.seek(block * block_size * 8)
+                data = f.read(block_size * 8)
+                table = struct.unpack('%dQ' % (len(data) // 8), data)
+            index = frame - block * block_size
+            values.append(index < len(table) and table[index] or 0)
+        return values
+    finally:
+        f.close()
+
+def getFrames(pid):
+    """Return a list of arrays of the frames of the present pages of pid.
+    Only mappings with resident pages are read from pagemap, to avoid
+    reading entries for large reserved but unused address ranges."""
+    f = proc.open_binary(pid, 'smaps')
+    try:
+        data = read_bytes(f)
+        vmas = []
+        for match in vma_re.finditer(data):
+            start, end, value = match.groups()
+            if start is not None:
+                vma = (int(start, 16), int(end, 16))
+            elif value != b'0' and (not vmas or vmas[-1] is not vma):
+                vmas.append(vma)
+    finally:
+        f.close()
+
+    frames = []
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    f = proc.open_binary(pid, 'pagemap')
+    try:
+        for start, end in vmas:
+            page = start // page_size
+            end //= page_size
+            while page < end:
+                count = min(end - page, PAGEMAP_CHUNK)
+                f.seek(page * 8)
+                frames.append(pagemap_frames(f.read(count * 8)))
+                page += count
+    except (IOError, OSError):
+        val = sys.exc_info()[1]
+        if val.errno == errno.ESRCH:
+            raise LookupError  # process gone
+        raise
+    finally:
+        f.close()
+    return frames
+
+
+def frames_id(frames):
+    """Return a digest of the frames of a process, which is the same
+    for processes sharing an address space, or None without frames"""
+    digest = hashlib.sha1()
+    present = False
+    for chunk in frames:
+        if len(chunk):
+            present = True
+            if numpy is not None:
+                digest.update(chunk.tobytes())
+            else:
+                digest.update(struct.pack('%dQ' % len(chunk), *chunk))
+    return present and digest.digest() or None
+
+
+def get_physical_usage(pids_to_show, split_args, discriminate_by_pid,
+                       include_self=False, jobs=1, group_key=None):
+    """Return the MemoryUsage per program from the physical pages mapped.
+    The private value of each program is the RAM mapped only by its
+    processes, and the shared value is the RAM also mapped by other
+    processes. The total is the RAM mapped, counting each page once."""
+    pids = list_pids(pids_to_show, include_self)[0]
+
+    def collect(pid):
+        try:
+            with ProcessDir(proc, pid):
+                cmd = get_proc_cmd(pid, split_args, discriminate_by_pid,
+                                   group_key=group_key)
+                frames = getFrames(pid)
+                return pid, cmd, frames_id(frames), frames
+        except LookupError:
+            return None  # kernel thread, process gone or not permitted
+
+    results = [result for result in map_jobs(collect, pids, jobs) if result]
+    # The frames of an address space shared by processes are only
+    # counted once, so that the mapping counts match kpagecount
+    duplicates = VmIdentity(proc).duplicates(
+        [(pid, cmd, frames_hash) for pid, cmd, frames_hash, frames in results]
+    )
+    groups = {}  # cmd -> [frames, pids]
+    for pid, cmd, frames_hash, frames in results:
+        group = groups.setdefault(cmd, [[], []])
+        group[1].append(pid)
+        if pid not in duplicates:
+            group[0].extend(frames)
+
+    # Frames mapped by each program, and the number of mappings of each
+    for cmd, group in groups.items():
+        group[0] = count_frames(group[0])
+    frames, programs_mapping = count_frames(
+        [group[0][0] for group in groups.values()]
+    )
+    mappings = read_frame_values('kpagecount', frames)
+    flags = read_frame_values('kpageflags', frames)
+
+    page_size = PAGESIZE
+    programs = []
+    if numpy is not None:
+        ram = (flags & numpy.uint64(KPF_NOPAGE | KPF_ZERO_PAGE)) == 0
+        total = int(numpy.count_nonzero(ram)) * page_size
+        for cmd, ((cmd_frames, counts), pids) in groups.items():
+            index = numpy.searchsorted(frames, cmd_frames)
+            valid = ram[index]
+            shared = valid & ((programs_mapping[index] > 1)
+                              | (mappings[index] > counts.astype(numpy.uint64)))
+            shared = int(numpy.count_nonzero(shared))
+            unique = int(numpy.count_nonzero(valid)) - shared
+            programs.append(ProgramUsage(cmd, unique * page_size,
+                                         shared * page_size, 0,
+                                         len(pids), tuple(pids)))
+    else:
+        info = {}  # frame -> (RAM, programs mapping, kpagecount)
+        for i, frame in enumerate(frames):
+            info[frame] = (not flags[i] & (KPF_NOPAGE | KPF_ZERO_PAGE),
+                           programs_mapping[i], mappings[i])
+        total = sum(1 for value in info.values() if value[0]) * page_size
+        for cmd, ((cmd_frames, counts), pids) in groups.items():
+            unique = shared = 0
+            for frame, count in zip(cmd_frames, counts):
+                valid, programs_count, mapping_count = info[frame]
+                if not valid:
+                    continue
+                if programs_count > 1 or mapping_count > count:
+                    shared += 1
+                else:
+                    unique += 1
+            programs.append(ProgramUsage(cmd, unique * page_size,
+                                         shared * page_size, 0,
+                                         len(pids), tuple(pids)))
+
+    programs = [program for program in programs if program.ram]
+    programs.sort(key=lambda program: program.ram)
+    return MemoryUsage(programs, total, 0, 1, 0)
+
+
+# Mapping headers and sizes from /proc/$pid/smaps, to apportion
+# the pages of each mapping in numa_maps by Pss
+numa_vma_re = re.compile(
+    br'(?:^|\n)([0-9a-f]+)-[0-9a-f]+ |\n(Rss|Pss):[ \t]*([0-9]+)'
+)
+numa_node_re = re.compile(br'N([0-9]+)=([0-9]+)$')
+
+NODE_ROOT = '/sys/devices/system/node'
+
+# Indexes of the values per node in NumaProgramUsage.nodes
+NUMA_ANON = 0
+NUMA_FILE = 1
+NUMA_HUGE = 2
+NUMA_NAMES = ('anon', 'file', 'huge')
+
+
+class NumaProgramUsage(namedtuple('NumaProgramUsage',
+                                  ProgramUsage._fields + ('nodes', 'remote'))):
+    """Memory used by a program, with nodes the RAM used on each NUMA node
+    as {node: [KiB indexed by NUMA_*]}, and remote whether most of that
+    is on nodes other than those of the CPUs its processes can run on."""
+    __slots__ = ()
+    ram = ProgramUsage.ram
+
+
+def parse_cpu_list(text):
+    """Return the set of cpus in a list like 0-3,8"""
+    cpus = set()
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def node_cpus(root=NODE_ROOT):
+    """Return {node: set of cpus}, or {} if that isn't available"""
+    nodes = {}
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return nodes
+    for name in names:
+        if name.startswith('node') and name[4:].isdigit():
+            with open(os.path.join(root, name, 'cpulist')) as f:
+                nodes[int(name[4:])] = parse_cpu_list(f.read().strip())
+    return nodes
+
+
+def getLocalNodes(pid, cpus):
+    """Return the set of nodes with cpus that pid is allowed to run on"""
+    for line in proc.open(pid, 'status'):
+        if line.startswith('Cpus_allowed_list:'):
+            allowed = parse_cpu_list(line.split(':', 1)[1].strip())
+            return set(node for node, node_cpus in cpus.items()
+                       if node_cpus & allowed)
+    return None
+
+
+def read_lines(f, size=64 * 1024):
+    """Yield the lines of the unbuffered binary file f, reading in chunks"""
+    rest = b''
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        lines = (rest + data).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def getNumaStats(pid):
+    """Return ({node: [KiB indexed by NUMA_*]}, mm_id) for the process,
+    from the pages of each mapping per node in numa_maps. These are scaled
+    by the Pss/Rss of the mapping in smaps, so that pages shared with other
+    processes are apportioned as in the RAM used, which they total.
+    mm_id identifies the address space, as it's the (usually randomized)
+    start addresses of the mappings with their Pss/Rss."""
+    f = proc.open_binary(pid, 'smaps')
+    try:
+        data = read_bytes(f)
+    finally:
+        f.close()
+    factors = {}  # mapping start -> Pss / Rss
+    vma = rss = None
+    for match in numa_vma_re.finditer(data):
+        start, field, value = match.groups()
+        if start is not None:
+            vma = int(start, 16)
+        elif field == b'Rss':
+            rss = int(value)
+        elif rss:
+            factors[vma] = int(value) / float(rss)
+    mm_id = tuple(sorted(factors.items()))
+
+    nodes = {}
+    f = proc.open_binary(pid, 'numa_maps')
+    try:
+        # numa_maps has a line per mapping with many fields,
+        # so is parsed as it's read rather than all at once
+        for line in read_lines(f):
+            fields = line.split()
+            if b'huge' in fields:
+                kind = NUMA_HUGE
+                factor = 1  # hugetlb pages are not in Rss or Pss
+            else:
+                factor = factors.get(int(fields[0], 16))
+                if not factor:
+                    continue
+                kind = NUMA_FILE
+                for field in fields:
+                    if field.startswith(b'anon=') or field in (b'heap',
+                                                               b'stack'):
+                        kind = NUMA_ANON
+                        break
+            pages = []
+            page_size = PAGESIZE
+            for field in fields[2:]:
+                match = numa_node_re.match(field)
+                if match:
+                    pages.append((int(match.group(1)), int(match.group(2))))
+                elif field.startswith(b'kernelpagesize_kB='):
+                    page_size = int(field[18:])
+            for node, count in pages:
+                values = nodes.get(node)
+                if values is None:
+                    values = nodes[node] = [0, 0, 0]
+                values[kind] += count * page_size * factor
+    except (IOError, OSError):
+        val = sys.exc_info()[1]
+        if val.errno == errno.ESRCH:
+            raise LookupError  # process gone
+        raise
+    finally:
+        f.close()
+    return nodes, mm_id
+
+
+def get_numa_usage(pids_to_show, split_args, discriminate_by_pid,
+                   include_self=False, jobs=1, group_key=None):
+    """Return the MemoryUsage of get_memory_usage(), with the programs
+    as NumaProgramUsage giving the RAM used per NUMA node"""
+    usage = get_memory_usage(pids_to_show, split_args, discriminate_by_pid,
+                             include_self=include_self, jobs=jobs,
+                             group_key=group_key)
+    cpus = {}
+    if proc.live:  # the nodes of an archive's system aren't known
+        cpus = node_cpus()
+
+    def collect(pid):
+        try:
+            with ProcessDir(proc, pid):
+                nodes, mm_id = getNumaStats(pid)
+                return pid, nodes, mm_id, cpus and getLocalNodes(pid, cpus)
+        except LookupError:
+            return None  # process gone or not permitted
+
+    pids = [pid for program in usage.programs for pid in program.pids]
+    stats = dict((result[0], result[1:])
+                 for result in map_jobs(collect, pids, jobs) if result)
+
+    programs = []
+    vm_identity = VmIdentity(proc)
+    for program in usage.programs:
+        pids = [pid for pid in program.pids if pid in stats]
+        # As in aggregate_usage(), only account once for an address space
+        duplicates = vm_identity.duplicates(
+            [(pid, program.name, stats[pid][1]) for pid in pids]
+        )
+        nodes = {}
+        local = remote = 0
+        for pid in pids:
+            if pid in duplicates:
+                continue
+            pid_nodes, mm_id, pid_local = stats[pid]
+            for node, values in pid_nodes.items():
+                totals = nodes.setdefault(node, [0, 0, 0])
+                for kind, value in enumerate(values):
+                    totals[kind] += value
+                if not pid_local:
+                    continue  # affinity not known
+                if node in pid_local:
+                    local += sum(values)
+                else:
+                    remote += sum(values)
+        programs.append(NumaProgramUsage(*(tuple(program) +
+                                           (nodes, remote > local))))
+    usage.programs = programs
+    return usage
+
+
+def numa_columns(programs):
+    """Return the (node, NUMA_* index) with RAM used by any of programs"""
+    columns = set()
+    for program in programs:
+        for node, values in program.nodes.items():
+            columns.update((node, kind) for kind, value in enumerate(values)
+                           if value)
+    return sorted(columns)
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+class CgroupMemory:
+    """Access to the memory accounting of the kernel per cgroup,
+    from the cgroup v2 hierarchy, or the v1 memory controller
+    hierarchy if that's mounted"""
+
+    def __init__(self, root=CGROUP_ROOT):
+        self.v1 = os.path.exists(os.path.join(root, 'memory',
+                                              'memory.usage_in_bytes'))
+        if self.v1:
+            self.root = os.path.join(root, 'memory')
+        elif (not os.path.exists(os.path.join(root, 'cgroup.controllers'))
+              and os.path.exists(os.path.join(root, 'unified'))):
+            self.root = os.path.join(root, 'unified')  # hybrid hierarchy
+        else:
+            self.root = root
+
+    def pid_cgroup(self, pid):
+        """Return the memory cgroup path of pid"""
+        path = '/'
+        for line in proc.open(pid, 'cgroup'):
+            hierarchy, controllers, cgroup = line.rstrip('\n').split(':', 2)
+            if self.v1:
+                if 'memory' in controllers.split(','):
+                    return cgroup
+            elif hierarchy == '0':
+                path = cgroup
+        return path
+
+    def stats(self, path):
+        """Return (current, anon, file) memory use in KiB of cgroup path,
+        including its descendants, or None if not available"""
+        cgroup = os.path.join(self.root, path.lstrip('/'))
+        if self.v1:
+            files = ('memory.usage_in_bytes', 'total_rss', 'total_cache')
+        else:
+            files = ('memory.current', 'anon', 'file')
+        try:
+            current = int(open(os.path.join(cgroup, files[0])).read())
+            stat = {}
+            for line in open(os.path.join(cgroup, 'memory.stat')):
+                key, value = line.split()
+                stat[key] = int(value)
+        except (IOError, OSError, ValueError):
+            return None
+        return (current / 1024.0, stat.get(files[1], 0) / 1024.0,
+                stat.get(files[2], 0) / 1024.0)
+
+    def walk(self, depth):
+        """Generate the cgroup paths at depth, or all with a negative depth"""
+        root_depth = self.root.rstrip('/').count('/')
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            level = dirpath.rstrip('/').count('/') - root_depth
+            if depth < 0 or level == depth:
+                yield '/' + os.path.relpath(dirpath, self.root).lstrip('.')
+            if level == depth:
+                del dirnames[:]
+
+
+def cgroup_at_depth(path, depth):
+    """Return cgroup path truncated to depth, if not negative"""
+    if depth < 0:
+        return path
+    return '/' + '/'.join([part for part in path.split('/') if part][:depth])
+
+
+def print_cgroup_usage(usage, show_swap, cgroups):
+    """Print usage grouped per cgroup, along with kernel accounting"""
+    output_string = " Private  +   Shared  =  RAM used"
+    if show_swap:
+        output_string += "   Swap used"
+    output_string += "    Kernel      Anon      File\tCgroup\n\n"
+    sys.stdout.write(output_string)
+    for program in usage.programs:
+        output_string = "%9s + %9s = %9s"
+        output_data = (human(program.private),
+                       human(program.shared), human(program.ram))
+        if show_swap:
+            output_string += "   %9s"
+            output_data += (human(program.swap),)
+        output_string += "   %9s %9s %9s\t%s\n"
+        stats = cgroups.stats(program.name) or ('-', '-', '-')
+        output_data += tuple(human(value) if value != '-' else value
+                             for value in stats)
+        output_data += (cmd_with_count(program.name, program.count),)
+        sys.stdout.write(output_string % output_data)
+    print_totals(usage, show_swap)
+
+
+def print_cgroup_stats(cgroups, depth):
+    """Print the kernel memory accounting of cgroups at depth,
+    without examining any processes"""
+    rows = []
+    for path in cgroups.walk(depth):
+        stats = cgroups.stats(path)
+        if stats:
+            rows.append((stats, path))
+    rows.sort()
+    sys.stdout.write("    Kernel      Anon      File\tCgroup\n\n")
+    for (current, anon, file_), path in rows:
+        sys.stdout.write("%9s %9s %9s\t%s\n" %
+                         (human(current), human(anon), human(file_), path))
+
+
+def print_header(show_swap, discriminate_by_pid, column="Program",
+                 private="Private", columns=()):
+    # columns are the titles of any columns following RAM used
+    output_string = " %7s  +   Shared  =  RAM used" % private
+    for title in columns:
+        output_string += "%12s" % title
+    if show_swap:
+        output_string += "   Swap used"
+    output_string += "\t" + column
+    if discriminate_by_pid:
+        output_string += "[pid]"
+    output_string += "\n\n"
+    sys.stdout.write(output_string)
+
+
+def print_memory_usage(usage, show_swap):
+    numa = usage.programs and isinstance(usage.programs[0], NumaProgramUsage)
+    if numa:
+        columns = numa_columns(usage.programs)
+    for program in usage.programs:
+
+        output_string = "%9s + %9s = %9s"
+        output_data = (human(program.private),
+                       human(program.shared), human(program.ram))
+        sampled = isinstance(program, SampledProgramUsage)
+        if sampled:
+            output_string += "   %9s"
+            output_data += (ci_human(program.ram_ci),)
+        if numa:
+            for node, kind in columns:
+                output_string += "   %9s"
+                output_data += (human(program.nodes.get(node,
+                                                        (0, 0, 0))[kind]),)
+        if show_swap:
+            output_string += "   %9s"
+            output_data += (human(program.swap),)
+        output_string += "\t%s\n"
+        name = cmd_with_count(program.name, program.count)
+        if sampled and program.sampled < program.count:
+            name += " [%d sampled]" % program.sampled
+        if numa and program.remote:
+            name += " [remote]"
+        output_data += (name,)
+
+        sys.stdout.write(output_string % output_data)
+
+    print_totals(usage, show_swap)
+
+
+def print_exited(usage, show_swap):
+    """Show the programs that started and exited since the previous sample"""
+    sys.stdout.write("Started and exited since the previous sample:\n")
+    for program in usage.exited:
+        output_string = "%9s + %9s = %9s"
+        output_data = (human(program.private),
+                       human(program.shared), human(program.ram))
+        if show_swap:
+            output_string += "   %9s"
+            output_data += (human(program.swap),)
+        output_string += "\t%s\n"
+        output_data += (cmd_with_count(program.name, program.count),)
+        sys.stdout.write(output_string % output_data)
+
+
+def print_totals(usage, show_swap):
+    if usage.skipped is not None:
+        sys.stdout.write("%s\nAvoided reading smaps of %d processes\n" %
+                         ("-" * 33, usage.skipped))
+        return
+
+    total = human(usage.total)
+    width = 33
+    if usage.programs and isinstance(usage.programs[0], SampledProgramUsage):
+        total += "   %9s" % ci_human(usage.ram_ci)
+        width += 12
+    if usage.programs and isinstance(usage.programs[0], NumaProgramUsage):
+        for node, kind in numa_columns(usage.programs):
+            total += "   %9s" % human(sum(program.nodes.get(node,
+                                                            (0, 0, 0))[kind]
+                                          for program in usage.programs))
+            width += 12
+
+    # Only show totals if appropriate
+    if usage.have_swap_pss and show_swap:  # kernel will have_pss
+        sys.stdout.write("%s\n%s%s%s%9s\n%s\n" %
+                         ("-" * (width + 12), " " * 24, total, " " * 3,
+                          human(usage.total_swap), "=" * (width + 12)))
+    elif usage.have_pss:
+        sys.stdout.write("%s\n%s%s\n%s\n" %
+                         ("-" * width, " " * 24, total, "=" * width))
+
+
+def print_total(usage, show_swap):
+    if show_swap and usage.have_swap_pss:
+        sys.stdout.write(human(usage.total_swap, units=1)+'\n')
+    elif not show_swap and usage.have_pss:
+        sys.stdout.write(human(usage.total, units=1)+'\n')
+
+
+class UsageWriter:
+    """Writer of each measurement as rows in JSON Lines or CSV format,
+    with exact values in bytes. There is a row per program, followed by
+    a total row with the accuracy of the values (as per val_accuracy()).
+    Programs estimated from a sample also have the number of processes
+    sampled, and the half width of the confidence interval of the RAM.
+    Each measurement is written and flushed at once, rather than a line
+    at a time, while still being available to consumers immediately."""
+
+    fields = ('time', 'type', 'name', 'private', 'shared', 'ram', 'swap',
+              'count', 'pids', 'ram_accuracy', 'swap_accuracy', 'skipped',
+              'sampled', 'ram_ci')
+
+    def __init__(self, output_format, stream=None, only_total=False):
+        self.format = output_format
+        self.stream = stream or sys.stdout
+        self.only_total = only_total
+        self.rows = []
+        if self.format == 'csv':
+            self.csv = csv.writer(self, lineterminator='\n')
+            self.csv.writerow(self.fields)
+
+    def write(self, data):
+        """Buffer data from the csv writer"""
+        self.rows.append(data)
+
+    def write_usage(self, usage, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        timestamp = round(timestamp, 3)
+        sampled = (usage.programs and
+                   isinstance(usage.programs[0], SampledProgramUsage))
+        if not self.only_total:
+            for program in usage.programs:
+                name = program.name
+                if sys.version_info < (3,):
+                    name = name.decode('utf-8', 'replace')
+                estimate = {}
+                if sampled:
+                    estimate = dict(sampled=program.sampled,
+                                    ram_ci=kib_bytes(program.ram_ci))
+                self.add_row(time=timestamp, type='program', name=name,
+                             private=kib_bytes(program.private),
+                             shared=kib_bytes(program.shared),
+                             ram=kib_bytes(program.ram),
+                             swap=kib_bytes(program.swap),
+                             count=program.count, pids=list(program.pids),
+                             **estimate)
+            for program in usage.exited or ():
+                name = program.name
+                if sys.version_info < (3,):
+                    name = name.decode('utf-8', 'replace')
+                self.add_row(time=timestamp, type='exited', name=name,
+                             private=kib_bytes(program.private),
+                             shared=kib_bytes(program.shared),
+                             ram=kib_bytes(program.ram),
+                             swap=kib_bytes(program.swap),
+                             count=program.count, pids=list(program.pids))
+        count = None  # Not known if only the total was measured
+        if usage.programs:
+            count = sum(program.count for program in usage.programs)
+        total_sampled = None
+        if sampled:
+            total_sampled = sum(program.sampled
+                                for program in usage.programs)
+        self.add_row(time=timestamp, type='total', ram=kib_bytes(usage.total),
+                     swap=kib_bytes(usage.total_swap), count=count,
+                     ram_accuracy=usage.ram_accuracy,
+                     swap_accuracy=usage.swap_accuracy,
+                     skipped=usage.skipped,
+                     sampled=total_sampled, ram_ci=kib_bytes(usage.ram_ci))
+        self.flush()
+
+    def add_row(self, **row):
+        if self.format == 'csv':
+            pids = row.get('pids')
+            if pids is not None:
+                row['pids'] = ' '.join(str(pid) for pid in pids)
+            values = [row.get(field) for field in self.fields]
+            self.csv.writerow(['' if value is None else value
+                               for value in values])
+        else:
+            row = dict((field, value) for field, value in row.items()
+                       if value is not None)
+            self.rows.append(json.dumps(row, sort_keys=True) + '\n')
+
+    def flush(self):
+        self.stream.write(''.join(self.rows))
+        self.stream.flush()
+        self.rows = []
+
+
+def kib_bytes(kib):
+    if kib is None:
+        return None  # not known
+    return int(round(kib * 1024))
+
+
+#
+#   Recording of measurements, in a compact append only format.
+#   The file starts with RECORDING_MAGIC, followed by records of the form:
+#
+#   'N' <len> <utf8 name>   Define the next program name id (from 0)
+#   'T' <time> <flags> <n>  A measurement of n programs, each as:
+#       <id> <ram> <shared> <swap> <count>
+#
+#   All numbers are LEB128 varints. <time> is the zigzag encoded change
+#   in milliseconds since the epoch from the previous measurement.
+#   <ram>, <shared> and <swap> are in units of 0.5KiB, and are zigzag
+#   encoded changes from the previous value recorded for that program.
+#
+
+RECORDING_MAGIC = b'PSMEMREC\x01'
+RECORDING_HAVE_PSS = 1
+RECORDING_HAVE_SWAP_PSS = 2
+RECORDING_BY_PID = 4
+
+def write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def zigzag(value):
+    if value < 0:
+        return -2 * value - 1
+    return 2 * value
+
+def unzigzag(value):
+    if value & 1:
+        return -(value >> 1) - 1
+    return value >> 1
+
+
+class Recording:
+    """Encoding state of a recording, i.e. the interned program names,
+    and the previous time and values for delta encoding."""
+
+    def __init__(self):
+        self.names = []
+        self.name_ids = {}
+        self.time = 0  # ms
+        self.values = {}  # name id -> (ram, shared, swap)
+
+    def encode(self, timestamp, usage, discriminate_by_pid=False):
+        buf = bytearray()
+        programs = []
+        for program in usage.programs:
+            name_id = self.name_ids.get(program.name)
+            if name_id is None:
+                name = program.name
+                if not isinstance(name, bytes):
+                    name = name.encode('utf-8', 'replace')
+                buf += b'N'
+                write_varint(buf, len(name))
+                buf += name
+                name_id = self.name_ids[program.name] = len(self.names)
+                self.names.append(program.name)
+            programs.append((name_id, program))
+
+        buf += b'T'
+        now = int(timestamp * 1000)
+        write_varint(buf, zigzag(now - self.time))
+        self.time = now
+        flags = 0
+        if usage.have_pss:
+            flags |= RECORDING_HAVE_PSS
+        if usage.have_swap_pss:
+            flags |= RECORDING_HAVE_SWAP_PSS
+        if discriminate_by_pid:
+            flags |= RECORDING_BY_PID
+        buf.append(flags)
+        write_varint(buf, len(programs))
+        for name_id, program in programs:
+            values = (int(round(program.ram * 2)),
+                      int(round(program.shared * 2)),
+                      int(round(program.swap * 2)))
+            prev = self.values.get(name_id, (0, 0, 0))
+            write_varint(buf, name_id)
+            for value, prev_value in zip(values, prev):
+                write_varint(buf, zigzag(value - prev_value))
+            write_varint(buf, program.count)
+            self.values[name_id] = values
+        return buf
+
+    def decode(self, data, pos=0):
+        """Generate (end offset, timestamp, flags, MemoryUsage)
+        for each complete measurement in data from pos"""
+        names = []  # names defined before the measurement
+        while pos < len(data):
+            try:
+                kind = data[pos]
+                pos += 1
+                if kind == ord('N'):
+                    size, pos = read_varint(data, pos)
+                    if pos + size > len(data):
+                        return  # truncated
+                    name = bytes(data[pos:pos + size])
+                    pos += size
+                    if sys.version_info >= (3,):
+                        name = name.decode('utf-8', 'replace')
+                    names.append(name)
+                    continue
+                if kind != ord('T'):
+                    raise ValueError('Invalid recording')
+                delta, pos = read_varint(data, pos)
+                timestamp = self.time + unzigzag(delta)
+                flags = data[pos]
+                pos += 1
+                n, pos = read_varint(data, pos)
+                values = {}
+                programs = []
+                total = total_swap = 0
+                for i in range(n):
+                    name_id, pos = read_varint(data, pos)
+                    prev = values.get(name_id) or \
+                        self.values.get(name_id, (0, 0, 0))
+                    ram_shared_swap = []
+                    for prev_value in prev:
+                        delta, pos = read_varint(data, pos)
+                        ram_shared_swap.append(prev_value + unzigzag(delta))
+                    count, pos = read_varint(data, pos)
+                    values[name_id] = ram, shared, swap = ram_shared_swap
+                    if name_id < len(self.names):
+                        name = self.names[name_id]
+                    else:
+                        name = names[name_id - len(self.names)]
+                    programs.append(ProgramUsage(
+                        name, (ram - shared) / 2.0,
+                        shared / 2.0, swap / 2.0, count, ()))
+                    total += ram / 2.0
+                    total_swap += swap / 2.0
+            except IndexError:
+                return  # truncated
+            # Only update state once the measurement is complete
+            for name in names:
+                self.name_ids[name] = len(self.names)
+                self.names.append(name)
+            names = []
+            self.time = timestamp
+            self.values.update(values)
+            usage = MemoryUsage(programs, total, total_swap,
+                                flags & RECORDING_HAVE_PSS,
+                                flags & RECORDING_HAVE_SWAP_PSS)
+            yield pos, timestamp / 1000.0, flags, usage
+
+
+def read_recording(path):
+    """Generate (timestamp, flags, MemoryUsage) for each measurement in path"""
+    data = bytearray(open(path, 'rb').read())
+    if data[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+        raise ValueError('%s is not a ps_mem recording' % path)
+    recording = Recording()
+    for pos, timestamp, flags, usage in recording.decode(
+            data, len(RECORDING_MAGIC)):
+        yield timestamp, flags, usage
+
+
+class RecordingWriter:
+    """Append measurements to a recording file, creating it if needed.
+    The encoding state is restored from any existing measurements,
+    and any partially written measurement is discarded."""
+
+    def __init__(self, path):
+        self.recording = Recording()
+        self.file = open(path, 'a+b')
+        self.file.seek(0)
+        data = bytearray(self.file.read())
+        if not data:
+            self.file.write(RECORDING_MAGIC)
+        elif data[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            raise ValueError('%s is not a ps_mem recording' % path)
+        else:
+            end = len(RECORDING_MAGIC)
+            for end, timestamp, flags, usage in self.recording.decode(
+                    data, end):
+                pass
+            if end != len(data):
+                self.file.truncate(end)
+        self.file.flush()
+
+    def write(self, timestamp, usage, discriminate_by_pid=False):
+        self.file.write(bytes(self.recording.encode(timestamp, usage,
+                                                    discriminate_by_pid)))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def replay(args):
+    """Show measurements from the recording args.replay"""
+    selected = None
+    samples = []
+    for timestamp, flags, usage in read_recording(args.replay):
+        if args.program is not None:
+            if args.since is not None and timestamp < args.since:
+                continue
+            if args.until is not None and timestamp > args.until:
+                break
+            for program in usage.programs:
+                if program.name == args.program:
+                    samples.append((timestamp, program))
+        elif args.at is None or timestamp <= args.at:
+            selected = timestamp, flags, usage
+        else:
+            break
+
+    if args.program is not None:
+        if not samples:
+            sys.stderr.write("No measurements of %s\n" % args.program)
+            sys.exit(1)
+        low = min(samples, key=lambda sample: sample[1].ram)
+        high = max(samples, key=lambda sample: sample[1].ram)
+        average = sum(program.ram for t, program in samples) / len(samples)
+        sys.stdout.write("%d measurements of %s from %s to %s\n" %
+                         (len(samples), args.program,
+                          format_time(samples[0][0]),
+                          format_time(samples[-1][0])))
+        sys.stdout.write("Minimum: %9s at %s\n" %
+                         (human(low[1].ram), format_time(low[0])))
+        sys.stdout.write("Average: %9s\n" % human(average))
+        sys.stdout.write("Maximum: %9s at %s\n" %
+                         (human(high[1].ram), format_time(high[0])))
+        return
+
+    if selected is None:
+        sys.stderr.write("No measurements in %s\n" % args.replay)
+        sys.exit(1)
+    timestamp, flags, usage = selected
+    if args.only_total:
+        print_total(usage, args.show_swap)
+    else:
+        sys.stdout.write("Measured at %s\n\n" % format_time(timestamp))
+        print_header(args.show_swap, flags & RECORDING_BY_PID)
+        print_memory_usage(usage, args.show_swap)
+
+
+#
+#   Capture of the /proc files needed to examine processes into a
+#   compressed tar archive, which can be examined on another system with
+#   --proc-root. Only reading is done on the captured system, as parsing
+#   and reporting is done when the archive is examined.
+#
+
+CAPTURE_PROCESS_FILES = ('stat', 'statm', 'status', 'cmdline', 'comm',
+                         'cgroup')
+CAPTURE_SYSTEM_FILES = ('sys/kernel/osrelease', 'meminfo')
+capture_member_re = re.compile(
+    r'(self|meminfo|sys/kernel/osrelease|[0-9]+/(stat|statm|status|cmdline'
+    r'|comm|cgroup|smaps|smaps_rollup|exe))$'
+)
+
+def capture_process(pid):
+    """Return [(name, data or None, link or None)] for the files of pid"""
+    files = []
+    try:
+        with ProcessDir(proc, pid):
+            try:
+                files.append(('exe', None, proc.readlink(pid, 'exe')))
+            except OSError:
+                pass  # kernel thread or not permitted
+            smaps = (proc.smaps_file(pid),)
+            if pid == proc.self_pid:
+                smaps = ('smaps', 'smaps_rollup')  # as probed by ps_mem
+            for name in CAPTURE_PROCESS_FILES + smaps:
+                if not name:
+                    continue  # smaps not supported
+                try:
+                    f = proc.open_binary(pid, name)
+                except LookupError:
+                    continue
+                try:
+                    files.append((name, bytes(read_bytes(f)), None))
+                finally:
+                    f.close()
+    except (LookupError, IOError, OSError):
+        return []  # process gone
+    return [('%d/%s' % (pid, name), data, link)
+            for name, data, link in files]
+
+
+def capture(path, pids_to_show, jobs=1):
+    """Write the files needed to examine the selected processes to
+    the compressed tar archive at path. Our own process is included
+    for use in probing the capabilities of the kernel."""
+    pids = list_pids(pids_to_show)[0]
+    if proc.self_pid is not None:
+        pids.append(proc.self_pid)
+    now = time.time()
+
+    def add(tar, name, data=None, link=None):
+        info = tarfile.TarInfo(name)
+        info.mtime = now
+        if link is not None:
+            info.type = tarfile.SYMTYPE
+            info.linkname = link
+            tar.addfile(info)
+        else:
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    # Favour speed over size, to minimize the load on the captured system
+    tar = tarfile.open(path, 'w:gz', compresslevel=1)
+    try:
+        for name in CAPTURE_SYSTEM_FILES:
+            f = proc.open_binary(name)
+            try:
+                add(tar, name, bytes(read_bytes(f)))
+            finally:
+                f.close()
+        if proc.self_pid is not None:
+            add(tar, 'self', link=str(proc.self_pid))
+        for files in map_jobs(capture_process, pids, jobs):
+            for name, data, link in files:
+                add(tar, name, data, link)
+    finally:
+        tar.close()
+
+
+def extract_capture(path):
+    """Extract the capture archive at path to a temporary directory,
+    which is removed at exit, and return the directory. Only the
+    members written by capture() are extracted, and they're created
+    here rather than by tarfile, so that a file is never written through
+    a link, or over another member, whatever the archive contains."""
+    root = tempfile.mkdtemp(prefix='ps_mem.')
+    atexit.register(shutil.rmtree, root, True)
+    tar = tarfile.open(path)
+    try:
+        names = set()
+        for member in tar:
+            if not capture_member_re.match(member.name):
+                continue
+            if member.name in names:
+                raise ValueError('%s is not a valid capture' % path)
+            names.add(member.name)
+            target = os.path.join(root, member.name)
+            parent = os.path.dirname(target)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if member.issym():
+                if (member.name == 'self' and member.linkname.isdigit()
+                        or member.name.endswith('/exe')):
+                    os.symlink(member.linkname, target)
+            elif member.isfile():
+                # O_EXCL fails rather than following an existing link
+                fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                             | os.O_NOFOLLOW, 0o600)
+                f = os.fdopen(fd, 'wb')
+                try:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+                finally:
+                    f.close()
+    finally:
+        tar.close()
+    return root
+
+
+#
+#   Exporting of metrics in the Prometheus/OpenMetrics text format
+#
+
+def metric_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_metrics(usage, top, duration, timestamp, openmetrics=False):
+    """Return the metrics text for usage, with the top programs
+    by RAM used labeled individually, and the rest combined in separate
+    ps_mem_other_* metrics, as any label value could be a program name"""
+    programs = usage.programs[-top:] if top else []
+    others = usage.programs[:len(usage.programs) - len(programs)]
+    series = [(metric_label(program.name), program.private, program.shared,
+               program.swap, program.count) for program in programs]
+
+    lines = []
+    def metric(name, help_text, values):
+        lines.append('# HELP ps_mem_%s %s' % (name, help_text))
+        lines.append('# TYPE ps_mem_%s gauge' % name)
+        for labels, value in values:
+            lines.append('ps_mem_%s%s %s' % (name, labels, repr(value)))
+    def per_program(index, scale):
+        return [('{program="%s"}' % row[0], int(row[index] * scale))
+                for row in series]
+
+    metric('private_bytes', 'Private memory used by program',
+           per_program(1, 1024))
+    metric('shared_bytes', 'Shared memory used by program',
+           per_program(2, 1024))
+    metric('swap_bytes', 'Swap used by program', per_program(3, 1024))
+    metric('processes', 'Number of processes of program',
+           per_program(4, 1))
+    if others:
+        def other(index, scale):
+            return [('', int(sum(program[index] for program in others)
+                             * scale))]
+        metric('other_private_bytes',
+               'Private memory used by programs not labeled', other(1, 1024))
+        metric('other_shared_bytes',
+               'Shared memory used by programs not labeled', other(2, 1024))
+        metric('other_swap_bytes', 'Swap used by programs not labeled',
+               other(3, 1024))
+        metric('other_processes',
+               'Number of processes of programs not labeled', other(4, 1))
+    if usage.have_pss:
+        metric('total_bytes', 'Total memory used by all programs',
+               [('', int(usage.total * 1024))])
+    if usage.have_swap_pss:
+        metric('total_swap_bytes', 'Total swap used by all programs',
+               [('', int(usage.total_swap * 1024))])
+    metric('scan_duration_seconds', 'Time taken to examine processes',
+           [('', duration)])
+    metric('scan_timestamp_seconds', 'Time processes were examined',
+           [('', timestamp)])
+    if openmetrics:
+        lines.append('# EOF')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def parse_exporter_address(value):
+    """Parse [HOST:]PORT or unix:PATH"""
+    if value.startswith('unix:'):
+        return value[5:]
+    host, sep, port = value.rpartition(':')
+    try:
+        return (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid address: %s' % value)
+
+
+class Exporter:
+    """Serve metrics from the last completed sample over HTTP.
+    Samples are taken in the background every interval seconds,
+    independently of requests, so that any number of scrapers
+    can't cause more frequent examination of processes."""
+
+    def __init__(self, sampler, interval, top):
+        self.sampler = sampler
+        self.interval = interval
+        self.top = top
+        self.snapshot = None  # (usage, duration, timestamp)
+
+    def sample_forever(self):
+        while True:
+            start = time.time()
+            try:
+                usage = self.sampler.sample()
+            except Exception:
+                sys.stderr.write("Error examining processes: %s\n" %
+                                 sys.exc_info()[1])
+            else:
+                self.snapshot = (usage, time.time() - start, start)
+            time.sleep(max(0, start + self.interval - time.time()))
+
+    def metrics(self, openmetrics=False):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        return format_metrics(snapshot[0], self.top, snapshot[1],
+                              snapshot[2], openmetrics)
+
+    def serve_forever(self, address):
+        if sys.version_info < (3,):
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn, UnixStreamServer
+        else:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn, UnixStreamServer
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                openmetrics = ('application/openmetrics-text' in
+                               self.headers.get('Accept', ''))
+                body = exporter.metrics(openmetrics)
+                if body is None:
+                    self.send_error(503, 'No sample available yet')
+                    return
+                self.send_response(200)
+                if openmetrics:
+                    self.send_header('Content-Type',
+                                     'application/openmetrics-text; '
+                                     'version=1.0.0; charset=utf-8')
+                else:
+                    self.send_header('Content-Type',
+                                     'text/plain; version=0.0.4; '
+                                     'charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        if isinstance(address, tuple):
+            class Server(ThreadingMixIn, HTTPServer):
+                daemon_threads = True
+        else:
+            class Server(ThreadingMixIn, UnixStreamServer):
+                daemon_threads = True
+            if os.path.exists(address):
+                os.unlink(address)
+        server = Server(address, Handler)
+
+        sampler = threading.Thread(target=self.sample_forever)
+        sampler.daemon = True
+        sampler.start()
+        server.serve_forever()
+
+
+def verify_environment(pids_to_show, proc_root=None):
+    if os.geteuid() != 0 and not pids_to_show and proc_root is None:
+        sys.stderr.write("Sorry, root permission required, or specify pids with -p\n")
+        sys.stderr.close()
+        sys.exit(1)
+
+    try:
+        kernel_ver()
+    except (IOError, OSError):
+        val = sys.exc_info()[1]
+        if val.errno == errno.ENOENT:
+            sys.stderr.write(
+              "Couldn't access " + proc.path('') + "\n"
+              "Only GNU/Linux and FreeBSD (with linprocfs) are supported\n")
+            sys.exit(2)
+        else:
+            raise
+
+def main():
+    # Force the stdout and stderr streams to be unbuffered
+    sys.stdout = Unbuffered(sys.stdout)
+    sys.stderr = Unbuffered(sys.stderr)
+
+    args = parse_options()
+    watch = args.watch
+    only_total = args.only_total
+    show_swap = args.show_swap
+
+    if args.replay is not None:
+        replay(args)
+        sys.stdout.close()
+        return
+
+    if args.cgroup_only:
+        print_cgroup_stats(CgroupMemory(), args.cgroup)
+        sys.stdout.close()
+        return
+
+    global proc
+    proc_class = Proc
+    if args.profile is not None:
+        global profiler
+        profiler = Profiler(args.profile)
+        proc_class = ProfilingProc
+    if args.proc_root is not None:
+        if os.path.isfile(args.proc_root):
+            proc = proc_class(extract_capture(args.proc_root))
+        else:
+            proc = proc_class(args.proc_root)
+    elif proc_class is not Proc:
+        proc = proc_class()
+
+    cache = None
+    if args.cache is not None:
+        global probes
+        cache = PersistentCache(args.cache)
+        probes = cache.probes
+
+    verify_environment(args.pids_to_show, args.proc_root)
+
+    pids_to_show = args.pids_to_show
+    if (args.uids or args.comm or args.exe or args.in_cgroup
+            or args.min_rss is not None):
+        pids_to_show = ProcessFilter(args.pids_to_show, args.uids, args.comm,
+                                     args.exe, args.in_cgroup, args.min_rss)
+
+    if args.capture is not None:
+        capture(args.capture, pids_to_show, args.jobs)
+        return
+
+    if args.mappings:
+        usage = get_mapping_usage(pids_to_show, jobs=args.jobs)
+        if only_total:
+            print_total(usage, show_swap)
+        else:
+            print_header(show_swap, False, 'Mapping')
+            print_memory_usage(usage, show_swap)
+        sys.stdout.close()
+        ram_accuracy, swap_accuracy = val_accuracy(show_swap)
+        show_val_accuracy(ram_accuracy, swap_accuracy, only_total, show_swap)
+        return
+
+    if args.tree is not None:
+        usage = get_tree_usage(pids_to_show, args.split_args, args.tree,
+                               jobs=args.jobs)
+        print_header(show_swap, False, 'Process tree')
+        print_memory_usage(usage, show_swap)
+        sys.stdout.close()
+        ram_accuracy, swap_accuracy = val_accuracy(show_swap)
+        show_val_accuracy(ram_accuracy, swap_accuracy, only_total, show_swap)
+        return
+
+    cgroups = None
+    group_key = None
+    if args.cgroup is not None:
+        cgroups = CgroupMemory()
+        def cgroup_key(pid):
+            return cgroup_at_depth(cgroups.pid_cgroup(pid), args.cgroup)
+        group_key = cgroup_key
+
+    if args.physical:
+        if os.geteuid() != 0:
+            sys.stderr.write("Sorry, root permission required for --physical\n")
+            sys.stderr.close()
+            sys.exit(1)
+        usage = get_physical_usage(pids_to_show, args.split_args,
+                                   args.discriminate_by_pid, jobs=args.jobs,
+                                   group_key=group_key)
+        if only_total:
+            print_total(usage, show_swap)
+        else:
+            print_header(show_swap, args.discriminate_by_pid,
+                         cgroups and 'Cgroup' or 'Program', 'Unique')
+            print_memory_usage(usage, show_swap)
+        sys.stdout.close()
+        return
+
+    if args.numa:
+        usage = get_numa_usage(pids_to_show, args.split_args,
+                               args.discriminate_by_pid, jobs=args.jobs,
+                               group_key=group_key)
+        print_header(show_swap, args.discriminate_by_pid,
+                     cgroups and 'Cgroup' or 'Program',
+                     columns=['N%d %s' % (node, NUMA_NAMES[kind])
+                              for node, kind in numa_columns(usage.programs)])
+        print_memory_usage(usage, show_swap)
+        sys.stdout.close()
+        ram_accuracy, swap_accuracy = val_accuracy(show_swap)
+        show_val_accuracy(ram_accuracy, swap_accuracy, only_total, show_swap)
+        return
+
+    events = None
+    if args.events:
+        try:
+            events = ProcEvents(pids_to_show, args.split_args,
+                                args.discriminate_by_pid, group_key)
+        except (AttributeError, socket.error):  # AF_NETLINK is Linux only
+            sys.stderr.write("Process events not available,"
+                             " listing all processes each iteration\n")
+
+    # Totals only are measured with -t, unless programs are recorded
+    sampler = Sampler(pids_to_show, args.split_args,
+                      args.discriminate_by_pid, jobs=args.jobs,
+                      cache_names=watch is not None,
+                      incremental=args.incremental, group_key=group_key,
+                      only_total=(only_total and group_key is None
+                                  and args.record is None),
+                      top=args.top, sample_size=args.sample,
+                      sample_time=args.sample_time, events=events)
+    if cache is not None:
+        sampler.name_cache = cache.name_cache(args.split_args,
+                                              args.discriminate_by_pid)
+
+    if args.exporter is not None:
+        sampler.name_cache = NameCache()
+        try:
+            Exporter(sampler, args.exporter_interval,
+                     args.exporter_top).serve_forever(args.exporter)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    recorder = None
+    if args.record is not None:
+        recorder = RecordingWriter(args.record)
+
+    writer = None
+    if args.format != 'human':
+        writer = UsageWriter(args.format, only_total=only_total)
+
+    def report(usage):
+        if recorder:
+            recorder.write(time.time(), usage, args.discriminate_by_pid)
+        if writer:
+            writer.write_usage(usage)
+        else:
+            show(usage)
+
+    def show(usage):
+        if only_total:
+            print_total(usage, show_swap)
+        elif cgroups:
+            print_cgroup_usage(usage, show_swap, cgroups)
+        else:
+            print_memory_usage(usage, show_swap)
+            if usage.exited:
+                print_exited(usage, show_swap)
+
+    if not only_total and not cgroups and not writer:
+        columns = ()
+        if args.sample is not None or args.sample_time is not None:
+            columns = ('+/- 95%',)
+        print_header(show_swap, args.discriminate_by_pid, columns=columns)
+
+    def show_peak(peak):
+        when, stall, available, usage = peak
+        heading = ("Peak of memory pressure at %s" %
+                   time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)))
+        if stall is not None:
+            heading += ", %.1f%% stalled" % stall
+        if available is not None:
+            heading += ", %.1f%% available" % available
+        if writer:
+            # The sample was already written, with this time
+            sys.stderr.write(heading + " (%.3f)\n" % when)
+            return
+        sys.stdout.write("\n%s:\n\n" % heading)
+        show(usage)
+        sys.stdout.write("\n")
+
+    if watch is not None:
+        schedule = WatchSchedule(watch, args.adaptive, args.pressure,
+                                 args.min_available, args.max_cpu)
+        try:
+            usage = sampler.sample()
+            while usage.programs or usage.total:
+                report(usage)
+                if args.incremental:
+                    sys.stderr.write("Re-read %d of %d processes\n" %
+                                     (sampler.stats_cache.reread,
+                                      sampler.stats_cache.examined))
+
+                sys.stdout.flush()
+                peak = schedule.wait()
+                while peak is not None:
+                    show_peak(peak)
+                    peak = schedule.wait()
+                usage = sampler.sample()
+                schedule.sampled(usage)
+            else:
+                (writer and sys.stderr or sys.stdout).write(
+                    'Process does not exist anymore.\n')
+        except KeyboardInterrupt:
+            pass
+    else:
+        # This is the default behavior
+        usage = sampler.sample()
+        report(usage)
+
+    if recorder:
+        recorder.close()
+
+    if cache is not None:
+        cache.save(sampler.name_cache, args.split_args,
+                   args.discriminate_by_pid)
 
     # We must close explicitly, so that any EPIPE exception
     # is handled by our excepthook, rather than the default
     # one which is reenabled after this script finishes.
     sys.stdout.close()
 
-    ram_accuracy, swap_accuracy = val_accuracy( show_swap )
+    if profiler is not None:
+        profiler.write(sys.stderr, args.format)
+
+    ram_accuracy, swap_accuracy = sampler.accuracy
     show_val_accuracy( ram_accuracy, swap_accuracy, only_total, show_swap )
 
 if __name__ == '__main__': main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# Compare the time getMemStats() takes to parse smaps and smaps_rollup,
+# to that of the previous parser, which split the files into lists of
+# decoded lines. The results of both are also checked to be the same,
+# for the processes of a --proc-root, which don't change while read.
+#
+# By default the readable processes of the running system are parsed,
+# otherwise those of a proc file system given with --proc-root,
+# like one generated by make_proc_fixture.py.
+#
+# Example:
+#   tools/bench_smaps_parser.py
+#   tools/bench_smaps_parser.py --proc-root /tmp/fakeproc
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import ps_mem
+
+
+def old_mem_stats(pid, smaps):
+    """The previous getMemStats() parsing of smaps,
+    returning (Private, Shared, Swap)"""
+    proc = ps_mem.proc
+    have_pss = have_swap_pss = 0
+    Private_lines = []
+    Shared_lines = []
+    Private_huge_lines = []
+    Shared_huge_lines = []
+    Pss_lines = []
+    Swap_lines = []
+    Swap_pss_lines = []
+
+    # Rss from statm, read by both the previous and current getMemStats()
+    int(proc.open(pid, 'statm').readline().split()[1])
+    lines = proc.open(pid, smaps).readlines()
+    hash(''.join(lines))  # was the mem_id
+    for line in lines:
+        if line.startswith("Private_Hugetlb:"):
+            Private_huge_lines.append(line)
+        elif line.startswith("Shared_Hugetlb:"):
+            Shared_huge_lines.append(line)
+        elif line.startswith("Shared"):
+            Shared_lines.append(line)
+        elif line.startswith("Private"):
+            Private_lines.append(line)
+        elif line.startswith("Pss:"):
+            have_pss = 1
+            Pss_lines.append(line)
+        elif line.startswith("Swap:"):
+            Swap_lines.append(line)
+        elif line.startswith("SwapPss:"):
+            have_swap_pss = 1
+            Swap_pss_lines.append(line)
+    Shared = sum([int(line.split()[1]) for line in Shared_lines])
+    Private = sum([int(line.split()[1]) for line in Private_lines])
+    Private_huge = sum([int(line.split()[1]) for line in Private_huge_lines])
+    if have_pss:
+        pss_adjust = 0.5
+        Pss = sum([float(line.split()[1])+pss_adjust for line in Pss_lines])
+        Shared = Pss - Private
+    Private += Private_huge
+    if have_swap_pss:
+        Swap = sum([int(line.split()[1]) for line in Swap_pss_lines])
+    else:
+        Swap = sum([int(line.split()[1]) for line in Swap_lines])
+    return Private, Shared, Swap
+
+
+def new_mem_stats(pid):
+    stats = ps_mem.getMemStats(pid)
+    return stats.private, stats.shared, stats.swap
+
+
+def readable_pids(smaps):
+    pids = []
+    for pid in ps_mem.list_pids(None, include_self=True)[0]:
+        try:
+            if ps_mem.proc.open_binary(pid, smaps).read(1):
+                pids.append(pid)  # not a kernel thread
+        except (LookupError, IOError, OSError):
+            pass  # not permitted or process gone
+    return pids
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the smaps parsing of getMemStats()'
+                    ' to the previous line based parser')
+    parser.add_argument('--proc-root', metavar='DIR',
+                        help='proc file system to read')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times to repeat each measurement, of which'
+                             ' the best is shown (default: %(default)s)')
+    args = parser.parse_args()
+
+    ps_mem.proc = ps_mem.Proc(args.proc_root)
+    sys.stdout.write('%-12s %6s %10s %12s %12s %8s\n' % (
+        'file', 'pids', 'KiB/pid', 'old us/pid', 'new us/pid', 'speedup'))
+    for smaps in ('smaps_rollup', 'smaps'):
+        ps_mem.proc.smaps = smaps
+        pids = readable_pids(smaps)
+        if not pids:
+            sys.stderr.write('No readable %s\n' % smaps)
+            continue
+        size = 0
+        for pid in pids:
+            f = ps_mem.proc.open_binary(pid, smaps)
+            try:
+                size += len(f.read())
+            finally:
+                f.close()
+        # The processes of the running system can change while read
+        for pid in (not ps_mem.proc.live and pids or ()):
+            old = old_mem_stats(pid, smaps)
+            new = new_mem_stats(pid)
+            if old != new:
+                sys.stderr.write('Mismatch for %d %s: %s != %s\n'
+                                 % (pid, smaps, old, new))
+
+        def old_parser():
+            for pid in pids:
+                old_mem_stats(pid, smaps)
+
+        def new_parser():
+            for pid in pids:
+                new_mem_stats(pid)
+
+        old_time = min(timeit.repeat(old_parser, number=1,
+                                     repeat=args.repeat))
+        new_time = min(timeit.repeat(new_parser, number=1,
+                                     repeat=args.repeat))
+        sys.stdout.write('%-12s %6d %10.1f %12.1f %12.1f %7.1fx\n' % (
+            smaps, len(pids), size / 1024.0 / len(pids),
+            old_time * 1e6 / len(pids), new_time * 1e6 / len(pids),
+            old_time / new_time))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Time the scanning of processes by ps_mem, using synthetic proc
+# file systems generated by make_proc_fixture.py, so that regressions
+# and optimizations can be measured without a loaded system.
+#
+# For each combination of process count and mappings per process,
+# get_memory_usage(), getMemStats() and getCmdName() are timed,
+# reading both smaps_rollup and the full smaps.
+#
+# Example:
+#   tools/benchmark.py --processes 100,1000 --mappings 10,100
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import ps_mem
+from make_proc_fixture import make_fixture
+
+
+def int_list(value):
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid list: %s' % value)
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def benchmark(root, smaps, repeat, jobs):
+    """Return the times in seconds to examine the processes at root
+    reading smaps, as (get_memory_usage, getMemStats per process,
+    getCmdName per process)"""
+    ps_mem.proc = ps_mem.Proc(root)
+    ps_mem.proc.smaps = smaps
+    pids = ps_mem.list_pids(None)[0]
+    # Kernel threads have no executable, and empty smaps
+    pids = [pid for pid in pids
+            if int(ps_mem.getStat(pid)[1][ps_mem.STAT_FLAGS])
+            & ps_mem.PF_KTHREAD == 0]
+
+    def usage():
+        ps_mem.get_memory_usage(None, False, False, jobs=jobs)
+
+    def mem_stats():
+        for pid in pids:
+            ps_mem.getMemStats(pid)
+
+    def cmd_name():
+        for pid in pids:
+            ps_mem.getCmdName(pid, False, False)
+
+    return (best_time(usage, repeat),
+            best_time(mem_stats, repeat) / len(pids),
+            best_time(cmd_name, repeat) / len(pids))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time ps_mem on synthetic proc file systems')
+    parser.add_argument('--processes', type=int_list, default=[100, 1000],
+                        help='comma separated process counts'
+                             ' (default: 100,1000)')
+    parser.add_argument('--mappings', type=int_list, default=[10, 100],
+                        help='comma separated mappings per process'
+                             ' (default: 10,100)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to repeat each measurement, of which'
+                             ' the best is shown (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='processes examined concurrently'
+                             ' (default: %(default)s)')
+    args = parser.parse_args()
+
+    sys.stdout.write('%9s %8s %-12s %12s %15s %15s\n' % (
+        'processes', 'mappings', 'file', 'usage ms', 'MemStats us/pid',
+        'CmdName us/pid'))
+    for processes in args.processes:
+        for mappings in args.mappings:
+            root = os.path.join(tempfile.mkdtemp(prefix='ps_mem-bench.'),
+                                'proc')
+            try:
+                make_fixture(root, processes, mappings)
+                for smaps in ('smaps_rollup', 'smaps'):
+                    usage, mem_stats, cmd_name = benchmark(
+                        root, smaps, args.repeat, args.jobs)
+                    sys.stdout.write('%9d %8d %-12s %12.1f %15.1f %15.1f\n'
+                                     % (processes, mappings, smaps,
+                                        usage * 1e3, mem_stats * 1e6,
+                                        cmd_name * 1e6))
+            finally:
+                shutil.rmtree(os.path.dirname(root))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# Generate a synthetic proc file system, to be examined with
+# ps_mem --proc-root, or timed with tools/benchmark.py.
+#
+# Processes are generated from a few typical programs, with a process
+# tree, processes sharing an address space as with CLONE_VM,
+# executables deleted or replaced since they were started, and
+# kernel threads. Each process has smaps and smaps_rollup with
+# the number of mappings requested, so that the parsing of full
+# smaps can be compared to that of the rollup.
+#
+# Example:
+#   tools/make_proc_fixture.py --processes 2000 /tmp/fakeproc
+#   ps_mem --proc-root /tmp/fakeproc
+
+import argparse
+import os
+import random
+import sys
+
+# (comm, exe, arguments, RSS KiB of a typical process)
+PROGRAMS = (
+    ('bash', '/usr/bin/bash', ['-l'], 4000),
+    ('sshd', '/usr/sbin/sshd', ['-D'], 7000),
+    ('python3', '/usr/bin/python3.11', ['/usr/bin/service.py'], 25000),
+    ('postgres', '/usr/lib/postgresql/15/bin/postgres', ['-D', '/srv/pg'],
+     60000),
+    ('java', '/usr/lib/jvm/java-17/bin/java', ['-Xmx2g', '-jar', 'app.jar'],
+     500000),
+    ('Web Content', '/usr/lib/firefox/firefox', ['-contentproc'], 150000),
+    ('nginx', '/usr/sbin/nginx', ['-g', 'daemon off;'], 9000),
+)
+
+KERNEL_THREADS = ('kthreadd', 'ksoftirqd/0', 'kworker/0:1', 'rcu_sched')
+
+PF_KTHREAD = 0x00200000
+PAGE_KIB = 4
+
+SMAPS_FIELDS = ('Rss', 'Pss', 'Pss_Dirty', 'Shared_Clean', 'Shared_Dirty',
+                'Private_Clean', 'Private_Dirty', 'Referenced', 'Anonymous',
+                'LazyFree', 'AnonHugePages', 'ShmemPmdMapped',
+                'FilePmdMapped', 'Shared_Hugetlb', 'Private_Hugetlb',
+                'Swap', 'SwapPss', 'Locked')
+ROLLUP_FIELDS = ('Rss', 'Pss', 'Pss_Dirty', 'Pss_Anon', 'Pss_File',
+                 'Pss_Shmem', 'Shared_Clean', 'Shared_Dirty',
+                 'Private_Clean', 'Private_Dirty', 'Referenced', 'Anonymous',
+                 'LazyFree', 'AnonHugePages', 'ShmemPmdMapped',
+                 'FilePmdMapped', 'Shared_Hugetlb', 'Private_Hugetlb',
+                 'Swap', 'SwapPss', 'Locked')
+
+
+def write_file(path, data):
+    f = open(path, 'w')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def exe_inode(exe):
+    """Return the inode number of the file exe, the same for each process"""
+    inode = 100000
+    for char in exe:
+        inode = (inode * 31 + ord(char)) % 900000
+    return 100000 + inode
+
+
+def make_mappings(rng, exe, rss, count):
+    """Return [(header, {field: KiB})] for count mappings totalling
+    about rss KiB, alternating between file and anonymous mappings"""
+    mappings = []
+    address = rng.randrange(0x550000000, 0x560000000) << 12
+    for i in range(count):
+        size = rng.choice((4, 8, 16, 132, 1024, 8192))
+        resident = min(size, max(PAGE_KIB, rss * 2 // count // PAGE_KIB
+                                 * PAGE_KIB))
+        resident = rng.randrange(0, resident + 1, PAGE_KIB)
+        anonymous = i % 3 == 2
+        shared = 0
+        if not anonymous:
+            shared = rng.randrange(0, resident + 1, PAGE_KIB)
+        private = resident - shared
+        swap = anonymous and rng.randrange(0, 2) * PAGE_KIB or 0
+        fields = dict.fromkeys(SMAPS_FIELDS, 0)
+        fields.update(Rss=resident, Pss=private + shared // 3,
+                      Shared_Clean=shared, Private_Dirty=private,
+                      Referenced=resident, Swap=swap, SwapPss=swap)
+        if anonymous:
+            fields['Anonymous'] = private
+            name = i == count - 1 and '[stack]' or ''
+            header = '%012x-%012x rw-p 00000000 00:00 0' % (
+                address, address + size * 1024)
+            header = name and '%-73s%s' % (header, name) or header
+        else:
+            header = '%-73s%s' % ('%012x-%012x r-xp %08x fd:01 %d' % (
+                address, address + size * 1024, i * 4096,
+                exe_inode(exe)), exe)
+        mappings.append((header, fields))
+        address += (size + 4) * 1024
+    return mappings
+
+
+def smaps_data(mappings):
+    lines = []
+    for header, fields in mappings:
+        lines.append(header)
+        size = (int(header.split('-')[1].split()[0], 16)
+                - int(header.split('-')[0], 16)) // 1024
+        lines.append('Size:           %8d kB' % size)
+        lines.append('KernelPageSize: %8d kB' % PAGE_KIB)
+        lines.append('MMUPageSize:    %8d kB' % PAGE_KIB)
+        for field in SMAPS_FIELDS:
+            lines.append('%-16s%8d kB' % (field + ':', fields[field]))
+        lines.append('THPeligible:    0')
+        lines.append('VmFlags: rd mr mw me ac sd')
+    return '\n'.join(lines) + '\n'
+
+
+def rollup_data(mappings):
+    totals = dict.fromkeys(ROLLUP_FIELDS, 0)
+    for header, fields in mappings:
+        for field, value in fields.items():
+            if field in totals:
+                totals[field] += value
+        if fields['Anonymous']:
+            totals['Pss_Anon'] += fields['Pss']
+        else:
+            totals['Pss_File'] += fields['Pss']
+    start = mappings[0][0].split('-')[0]
+    end = mappings[-1][0].split('-')[1].split()[0]
+    lines = ['%-73s%s' % ('%s-%s ---p 00000000 00:00 0' % (start, end),
+                          '[rollup]')]
+    for field in ROLLUP_FIELDS:
+        lines.append('%-16s%8d kB' % (field + ':', totals[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def stat_data(pid, comm, ppid, flags, starttime, rss_pages, vsize):
+    fields = ['S', ppid, pid, pid, 0, -1, flags, 1500, 0, 12, 0, 40, 10,
+              0, 0, 20, 0, 1, 0, starttime, vsize, rss_pages]
+    fields += [0] * (52 - 2 - len(fields))
+    return '%d (%s) %s\n' % (pid, comm, ' '.join(str(f) for f in fields))
+
+
+def status_data(pid, comm, ppid, uid, rss):
+    return ('Name:\t%s\nUmask:\t0022\nState:\tS (sleeping)\nTgid:\t%d\n'
+            'Ngid:\t0\nPid:\t%d\nPPid:\t%d\nTracerPid:\t0\n'
+            'Uid:\t%d\t%d\t%d\t%d\nGid:\t%d\t%d\t%d\t%d\n'
+            'VmRSS:\t%8d kB\nThreads:\t1\n'
+            % (comm, pid, pid, ppid, uid, uid, uid, uid,
+               uid, uid, uid, uid, rss))
+
+
+def make_process(root, pid, comm, ppid, uid=0, exe=None, args=(),
+                 mappings=None, kthread=False, starttime=100):
+    path = os.path.join(root, str(pid))
+    os.mkdir(path)
+    rss = vsize = 0
+    if mappings:
+        rss = sum(fields['Rss'] for header, fields in mappings)
+        vsize = sum(int(h.split('-')[1].split()[0], 16)
+                    - int(h.split('-')[0], 16) for h, fields in mappings)
+    flags = kthread and PF_KTHREAD or 0x400100
+    write_file(os.path.join(path, 'stat'),
+               stat_data(pid, comm, ppid, flags, starttime,
+                         rss // PAGE_KIB, vsize))
+    write_file(os.path.join(path, 'status'),
+               status_data(pid, comm, ppid, uid, rss))
+    write_file(os.path.join(path, 'comm'), comm + '\n')
+    write_file(os.path.join(path, 'cgroup'),
+               kthread and '0::/\n' or '0::/system.slice/%s.service\n'
+               % comm.split()[0].lower())
+    pages = rss // PAGE_KIB
+    write_file(os.path.join(path, 'statm'), '%d %d %d %d 0 %d 0\n' % (
+        vsize // 4096, pages, pages // 3, pages // 10, pages // 2))
+    if kthread:
+        write_file(os.path.join(path, 'cmdline'), '')
+        write_file(os.path.join(path, 'smaps'), '')
+        write_file(os.path.join(path, 'smaps_rollup'), '')
+        return
+    write_file(os.path.join(path, 'cmdline'),
+               '\0'.join([exe.split(' (deleted)')[0]] + list(args)) + '\0')
+    os.symlink(exe, os.path.join(path, 'exe'))
+    write_file(os.path.join(path, 'smaps'), smaps_data(mappings))
+    write_file(os.path.join(path, 'smaps_rollup'), rollup_data(mappings))
+
+
+def make_fixture(root, processes=1000, mappings=40, clone_vm=0.02,
+                 deleted=0.02, seed=0):
+    """Create a proc file system at root with about processes pids,
+    each with about mappings mappings in smaps"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root, 'sys', 'kernel'))
+    write_file(os.path.join(root, 'sys', 'kernel', 'osrelease'),
+               '6.1.0-18-amd64\n')
+    write_file(os.path.join(root, 'meminfo'),
+               'MemTotal:       65536000 kB\nMemFree:        20000000 kB\n'
+               'MemAvailable:   40000000 kB\nSwapTotal:       8000000 kB\n'
+               'SwapFree:        7000000 kB\n')
+
+    make_process(root, 1, 'systemd', 0, exe='/usr/lib/systemd/systemd',
+                 mappings=make_mappings(rng, '/usr/lib/systemd/systemd',
+                                        12000, mappings))
+    pid = 2
+    for comm in KERNEL_THREADS:
+        make_process(root, pid, comm, 2, kthread=True)
+        pid += 1
+
+    parents = {}  # comm -> pids, to create children of the same program
+    previous = None  # (comm, exe, args, mappings) of the last process
+    while pid < processes:
+        if previous is not None and rng.random() < clone_vm:
+            # Shares the address space of the previous process,
+            # so has the same memory statistics
+            comm, exe, args, vm = previous
+            make_process(root, pid, comm, pid - 1, exe=exe, args=args,
+                         mappings=vm, starttime=100 + pid)
+            pid += 1
+            continue
+        comm, exe, args, rss = rng.choice(PROGRAMS)
+        if rng.random() < deleted:
+            exe += ' (deleted)'
+        ppid = rng.choice(parents.get(comm, [1]))
+        count = max(1, int(rng.gauss(mappings, mappings / 4.0)))
+        vm = make_mappings(rng, exe.split(' (deleted)')[0],
+                           int(rss * rng.uniform(0.5, 1.5)), count)
+        uid = rng.choice((0, 1000, 1001))
+        make_process(root, pid, comm, ppid, uid, exe, args, vm,
+                     starttime=100 + pid)
+        parents.setdefault(comm, []).append(pid)
+        previous = comm, exe, args, vm
+        pid += 1
+
+    # ps_mem itself, excluded from the processes reported
+    exe = '/usr/bin/python3.11'
+    make_process(root, pid, 'ps_mem', 1, exe=exe, args=['/usr/bin/ps_mem'],
+                 mappings=make_mappings(rng, exe, 10000, mappings),
+                 starttime=100 + pid)
+    os.symlink(str(pid), os.path.join(root, 'self'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic proc file system for ps_mem')
+    parser.add_argument('root', help='directory to create')
+    parser.add_argument('--processes', type=int, default=1000,
+                        help='number of pids (default: %(default)s)')
+    parser.add_argument('--mappings', type=int, default=40,
+                        help='average mappings per process'
+                             ' (default: %(default)s)')
+    parser.add_argument('--clone-vm', type=float, default=0.02,
+                        help='fraction of processes sharing the address'
+                             ' space of another (default: %(default)s)')
+    parser.add_argument('--deleted', type=float, default=0.02,
+                        help='fraction of processes with a deleted'
+                             ' executable (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.root):
+        parser.error('%s already exists' % args.root)
+    make_fixture(args.root, args.processes, args.mappings, args.clone_vm,
+                 args.deleted, args.seed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())